@@ -0,0 +1,314 @@
+# Offline benchmark of LMI on synthetic networks, amenities and cohorts of users
+# Run from the root of the repository so LMI.py can be imported:
+#
+#     python Benchmark/benchmark.py --output bench.json
+#     python Benchmark/benchmark.py --quick --output new.json --compare bench.json
+#
+# Nothing is downloaded: the network is given to LMI as an in memory OSMExtract and the amenities through pois.
+# Every case runs in a fresh process, so the peak memory reported for a case is the one of that case only.
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import concurrent.futures
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import LMI
+
+# origin of the synthetic area, in London, Ontario like the example
+LON0 = -81.25
+LAT0 = 43.0
+
+# meters to degrees around the origin
+METERS_LON = 111320 * np.cos(np.radians(LAT0))
+METERS_LAT = 110540
+
+
+def to_lonlat(x, y):
+
+    return LON0 + np.asarray(x) / METERS_LON, LAT0 + np.asarray(y) / METERS_LAT
+
+
+# Square grid of side x side intersections spacing meters apart, slightly moved, with a share of the streets removed
+# and lengths a little longer than the straight line like real streets
+def grid_network(side, spacing = 100, drop = 0.1, seed = 0):
+
+    rng = np.random.default_rng(seed)
+
+    i, j = np.meshgrid(np.arange(side), np.arange(side), indexing='ij')
+    x = i.ravel() * spacing + rng.normal(0, spacing * 0.05, side * side)
+    y = j.ravel() * spacing + rng.normal(0, spacing * 0.05, side * side)
+    ids = np.arange(side * side)
+
+    horizontal = np.column_stack((ids[:-side], ids[side:]))
+    vertical = ids.reshape(side, side)[:, :-1].ravel()
+    vertical = np.column_stack((vertical, vertical + 1))
+    pairs = np.concatenate((horizontal, vertical))
+    pairs = pairs[rng.uniform(size=len(pairs)) > drop]
+
+    return network_arrays(x, y, pairs, rng)
+
+
+# Random planar network: the delaunay triangulation of uniformly drawn intersections, without its longest edges
+def planar_network(nodes, spacing = 100, seed = 0):
+
+    from scipy.spatial import Delaunay
+
+    rng = np.random.default_rng(seed)
+
+    size = np.sqrt(nodes) * spacing
+    x = rng.uniform(0, size, nodes)
+    y = rng.uniform(0, size, nodes)
+
+    simplices = Delaunay(np.column_stack((x, y))).simplices
+    pairs = np.concatenate((simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [2, 0]]))
+    pairs = np.unique(np.sort(pairs, axis=1), axis=0)
+
+    lengths = np.hypot(x[pairs[:, 0]] - x[pairs[:, 1]], y[pairs[:, 0]] - y[pairs[:, 1]])
+    pairs = pairs[lengths < 2 * spacing]
+
+    return network_arrays(x, y, pairs, rng)
+
+
+def network_arrays(x, y, pairs, rng):
+
+    lengths = np.hypot(x[pairs[:, 0]] - x[pairs[:, 1]], y[pairs[:, 0]] - y[pairs[:, 1]]) * (1 + rng.uniform(0, 0.2, len(pairs)))
+    lon, lat = to_lonlat(x, y)
+
+    # both directions of every street, like the graphs of osmnx
+    return {
+        'osmid': np.arange(len(x)) + 1000,
+        'x': lon,
+        'y': lat,
+        'u': np.concatenate((pairs[:, 0], pairs[:, 1])) + 1000,
+        'v': np.concatenate((pairs[:, 1], pairs[:, 0])) + 1000,
+        'length': np.concatenate((lengths, lengths)),
+    }, (x, y)
+
+
+# Amenities next to random intersections, the number of amenities of each type following a Zipf law
+def amenity_layer(count, types, network_xy, seed = 0):
+
+    rng = np.random.default_rng(seed)
+
+    x, y = network_xy
+    at = rng.integers(0, len(x), count)
+    weights = 1 / np.arange(1, types + 1)
+
+    lon, lat = to_lonlat(x[at] + rng.normal(0, 20, count), y[at] + rng.normal(0, 20, count))
+    amenity = np.array(['type_' + str(k) for k in range(types)])[rng.choice(types, count, p=weights / weights.sum())]
+
+    index = pd.MultiIndex.from_arrays([['node'] * count, np.arange(count) + 10_000_000], names=['element_type', 'osmid'])
+
+    return gpd.GeoDataFrame({'amenity': amenity}, geometry=gpd.points_from_xy(lon, lat), index=index, crs='EPSG:4326')
+
+
+# Stop points of users who keep going back to a few places: home, work and favourite places, some of them amenities,
+# and sometimes explore a new place. The places are visited following a Zipf law, with log-normal dwell times
+def cohort(users, stops, pois, network_xy, places = 20, explore = 0.1, seed = 0):
+
+    rng = np.random.default_rng(seed)
+
+    x, y = network_xy
+    poi_x = (pois.geometry.x.values - LON0) * METERS_LON
+    poi_y = (pois.geometry.y.values - LAT0) * METERS_LAT
+
+    frames = []
+    homes = {}
+    for user in range(users):
+        # the places of the user around their home, half of the favourite places are amenities
+        home = rng.integers(0, len(x))
+        near = np.flatnonzero(np.hypot(poi_x - x[home], poi_y - y[home]) < 3000)
+        if len(near) == 0:
+            near = np.arange(len(poi_x))
+        chosen = rng.choice(near, places // 2)
+        other = rng.integers(0, len(x), places - places // 2)
+        place_x = np.concatenate(([x[home]], poi_x[chosen], x[other]))
+        place_y = np.concatenate(([y[home]], poi_y[chosen], y[other]))
+
+        weights = 1 / np.arange(1, len(place_x) + 1)
+        visits = rng.choice(len(place_x), stops, p=weights / weights.sum())
+        stop_x = place_x[visits]
+        stop_y = place_y[visits]
+
+        # new places, anywhere in the area
+        new = rng.uniform(size=stops) < explore
+        stop_x[new] = rng.uniform(x.min(), x.max(), int(new.sum()))
+        stop_y[new] = rng.uniform(y.min(), y.max(), int(new.sum()))
+
+        # gps noise, and a median stay of 30 minutes, longer at home
+        lon, lat = to_lonlat(stop_x + rng.normal(0, 10, stops), stop_y + rng.normal(0, 10, stops))
+        t = rng.lognormal(np.log(30 * 60), 1, stops)
+        t[visits == 0] *= 8
+
+        frames.append(gpd.GeoDataFrame({'user_id': user, 't': t}, geometry=gpd.points_from_xy(lon, lat), crs='EPSG:4326'))
+        homes[user] = tuple(float(value) for value in to_lonlat(x[home], y[home]))
+
+    return gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), crs='EPSG:4326'), homes
+
+
+# The cases of each suite grow one dimension, the others stay at their default size
+DEFAULT = {'network': 'grid', 'nodes': 3600, 'pois': 500, 'types': 20, 'stops': 200, 'users': 1}
+
+SUITES = {
+    'stops': [{'stops': stops} for stops in (100, 1000, 10000)],
+    'pois': [{'pois': pois} for pois in (100, 1000, 10000)],
+    'nodes': [{'network': network, 'nodes': nodes} for network in ('grid', 'planar') for nodes in (900, 10000, 90000)],
+    'users': [{'users': users} for users in (10, 100, 1000)],
+}
+
+QUICK = {
+    'stops': [{'stops': stops} for stops in (100, 1000)],
+    'pois': [{'pois': pois} for pois in (100, 1000)],
+    'nodes': [{'network': network, 'nodes': nodes} for network in ('grid', 'planar') for nodes in (900, 3600)],
+    'users': [{'users': users} for users in (10, 50)],
+}
+
+
+def case_name(suite, params):
+
+    return suite + ':' + ','.join(key + '=' + str(params[key]) for key in sorted(params))
+
+
+def run_case(params, repeat = 1, seed = 0, poiCutoff = 100, nonPoiMaxDistance = 5000, networkBufferAreaSize = 500):
+
+    # the inputs are generated outside of the timing
+    if params['network'] == 'grid':
+        arrays, network_xy = grid_network(int(round(np.sqrt(params['nodes']))), seed=seed)
+    else:
+        arrays, network_xy = planar_network(params['nodes'], seed=seed)
+    pois = amenity_layer(params['pois'], params['types'], network_xy, seed=seed + 1)
+    stop_points, homes = cohort(params['users'], params['stops'], pois, network_xy, seed=seed + 2)
+
+    best = None
+    for _ in range(repeat):
+        # a new extract every time, so the network is clipped and built again like for new data
+        source = LMI.OSMExtract.from_arrays(**arrays)
+        stats = LMI.LMIStats()
+
+        start = time.perf_counter()
+        if params['users'] == 1:
+            values = [LMI.LMI(stop_points, homes[0], poiCutoff, nonPoiMaxDistance, networkBufferAreaSize=networkBufferAreaSize,
+                              pois=pois, stats=stats, source=source)]
+        else:
+            values = LMI.LMI_batch(stop_points, homes, poiCutoff, nonPoiMaxDistance, networkBufferAreaSize=networkBufferAreaSize,
+                                   pois=pois, stats=stats, source=source)['LMI'].values
+        seconds = time.perf_counter() - start
+
+        if best is None or seconds < best[0]:
+            best = (seconds, stats, values)
+
+    seconds, stats, values = best
+
+    return {
+        'params': params,
+        'seconds': seconds,
+        'users_per_second': params['users'] / seconds,
+        'stops_per_second': len(stop_points) / seconds,
+        'mean_LMI': float(np.nanmean(values)),
+        **stats.as_dict(),
+    }
+
+
+def run_isolated(params, repeat, seed):
+
+    # stdout of the case process goes to /dev/null, pandana prints the progress of its queries
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+
+    # LMI imports its dependencies when they are first used, they are imported here so the import time is not measured
+    import osmnx
+    import pandana
+    import pyproj
+    import scipy.sparse.csgraph
+    import scipy.spatial
+
+    return run_case(params, repeat, seed)
+
+
+# Cases whose wall time, or the time of one of their stages, grew by more than tolerance over the baseline.
+# The stages shorter than min_seconds in both runs are left out, their time is mostly noise
+def compare(results, baseline, tolerance = 0.25, min_seconds = 0.05):
+
+    baseline = {case['name']: case for case in baseline['cases']}
+
+    regressions = []
+    for case in results['cases']:
+        if case['name'] not in baseline:
+            continue
+        before = baseline[case['name']]
+
+        timings = [('total', before['seconds'], case['seconds'])]
+        timings += [(stage, before['times'][stage], case['times'][stage]) for stage in case['times'] if stage in before['times']]
+
+        for stage, old, new in timings:
+            if max(old, new) >= min_seconds and new > old * (1 + tolerance):
+                regressions.append({'case': case['name'], 'stage': stage, 'baseline': old, 'seconds': new, 'ratio': new / old})
+
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Offline benchmark of LMI on synthetic inputs.')
+    parser.add_argument('--output', default='bench_output.json', help='JSON file the results are written to')
+    parser.add_argument('--suites', nargs='+', choices=sorted(SUITES), default=sorted(SUITES))
+    parser.add_argument('--quick', action='store_true', help='smaller cases, for a check in a few minutes')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each case, the fastest one is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compare', help='JSON file of a previous run, the regressions are listed and the exit code is 1')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='relative slowdown reported as a regression')
+    args = parser.parse_args()
+
+    suites = QUICK if args.quick else SUITES
+
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpus': os.cpu_count(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'geopandas': gpd.__version__,
+        },
+        'settings': {'quick': args.quick, 'repeat': args.repeat, 'seed': args.seed},
+        'cases': [],
+    }
+
+    context = multiprocessing.get_context('spawn')
+    for suite in args.suites:
+        for case in suites[suite]:
+            params = {**DEFAULT, **case}
+            name = case_name(suite, case)
+
+            with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+                result = executor.submit(run_isolated, params, args.repeat, args.seed).result()
+
+            results['cases'].append({'name': name, 'suite': suite, **result})
+            print(name, '%.3f s' % result['seconds'], '%.0f stops/s' % result['stops_per_second'],
+                  '%.0f MB' % (result['peak_memory'] / 1e6 if result['peak_memory'] else 0), flush=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, default=float)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('regression', regression['case'], regression['stage'], '%.3f s -> %.3f s' % (regression['baseline'], regression['seconds']))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+# Local HTTP stand-in for Overpass, replaying a fixed synthetic network and amenity layer as Overpass JSON, and a check
+# of the prefetching of LMI_batch against it. Run from the root of the repository so LMI.py can be imported:
+#
+#     python Benchmark/overpass_stub.py --prefetch 2 --delay 0.5
+#
+# The downloads of LMI are sent to the stand-in with set_overpass_url, the cohort is scored without and with prefetching,
+# and the exit code is 1 when the results differ or when the downloads of the next regions did not overlap.
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import LMI
+from benchmark import amenity_layer, grid_network, to_lonlat
+
+
+class OverpassStub:
+
+    def __init__(self, arrays, pois, delay = 0, host = '127.0.0.1', port = 0):
+
+        # the responses are the same for every area, osmnx clips the network and the amenities to the polygon it asked for
+        self.network = self.network_response(arrays)
+        self.amenities = self.amenity_response(pois)
+        self.delay = delay
+
+        # requests answered, and the most requests answered at once
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.active = 0
+        self.max_active = 0
+
+        self.server = ThreadingHTTPServer((host, port), _handler(self))
+        self.url = 'http://' + host + ':' + str(self.server.server_address[1]) + '/api'
+
+    def network_response(self, arrays):
+
+        # the nodes, and a way for each street, the arrays have both directions of every street
+        nodes = [{'type': 'node', 'id': int(osmid), 'lon': float(x), 'lat': float(y)} for osmid, x, y in zip(arrays['osmid'], arrays['x'], arrays['y'])]
+        streets = [(int(u), int(v)) for u, v in zip(arrays['u'], arrays['v']) if u < v]
+        ways = [{'type': 'way', 'id': 1_000_000 + i, 'nodes': [u, v], 'tags': {'highway': 'residential'}} for i, (u, v) in enumerate(streets)]
+
+        return json.dumps({'version': 0.6, 'elements': nodes + ways}).encode('utf-8')
+
+    def amenity_response(self, pois):
+
+        elements = [{'type': 'node', 'id': int(osmid), 'lon': float(point.x), 'lat': float(point.y), 'tags': {'amenity': amenity}}
+                    for (_, osmid), amenity, point in zip(pois.index, pois['amenity'], pois.geometry)]
+
+        return json.dumps({'version': 0.6, 'elements': elements}).encode('utf-8')
+
+    def answer(self, query):
+
+        with self.lock:
+            self.requests += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+
+        # the time a real server takes to answer
+        time.sleep(self.delay)
+
+        with self.lock:
+            self.active -= 1
+
+        return self.amenities if 'amenity' in query else self.network
+
+    def start(self):
+
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _handler(stub):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+
+            # osmnx posts the query as the data field of a form
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+            query = urllib.parse.parse_qs(body).get('data', [''])[0]
+
+            data = stub.answer(query)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+
+            pass
+
+    return Handler
+
+
+# Users staying around their home, the homes far enough apart for every user to be in a region of their own
+def clustered_users(users, stops, network_xy, spread = 300, seed = 0):
+
+    rng = np.random.default_rng(seed)
+
+    x, y = network_xy
+    side = int(np.ceil(np.sqrt(users)))
+    size = x.max() - x.min()
+
+    frames = []
+    homes = {}
+    for user in range(users):
+        home_x = x.min() + (user % side + 0.5) * size / side
+        home_y = y.min() + (user // side + 0.5) * size / side
+
+        lon, lat = to_lonlat(home_x + rng.uniform(-spread, spread, stops), home_y + rng.uniform(-spread, spread, stops))
+        t = rng.lognormal(np.log(30 * 60), 1, stops)
+
+        frames.append(gpd.GeoDataFrame({'user_id': user, 't': t}, geometry=gpd.points_from_xy(lon, lat), crs='EPSG:4326'))
+        homes[user] = tuple(float(value) for value in to_lonlat(home_x, home_y))
+
+    return gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), crs='EPSG:4326'), homes
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Checks the prefetching of LMI_batch against a local Overpass stand-in.')
+    parser.add_argument('--prefetch', type=int, default=2, help='regions prefetched while scoring')
+    parser.add_argument('--delay', type=float, default=0.5, help='seconds the stand-in takes to answer a request')
+    parser.add_argument('--users', type=int, default=6)
+    parser.add_argument('--stops', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    import osmnx as ox
+
+    # every download goes to the stand-in, none is answered from the cache of osmnx
+    ox.settings.use_cache = False
+
+    arrays, network_xy = grid_network(50, seed=args.seed)
+    pois = amenity_layer(400, 10, network_xy, seed=args.seed + 1)
+    stop_points, homes = clustered_users(args.users, args.stops, network_xy, seed=args.seed + 2)
+
+    stub = OverpassStub(arrays, pois, args.delay)
+    stub.start()
+    LMI.set_overpass_url(stub.url)
+
+    results = {}
+    try:
+        for prefetch in (0, args.prefetch):
+            stub.requests = 0
+            stub.max_active = 0
+
+            start = time.perf_counter()
+            results[prefetch] = LMI.LMI_batch(stop_points, homes, 100, 3000, networkBufferAreaSize=300, maxRegionArea=3e6, prefetch=prefetch)
+            seconds = time.perf_counter() - start
+
+            print('prefetch', prefetch, '%.2f s' % seconds, results[prefetch].attrs['networks_built'], 'regions',
+                  stub.requests, 'requests', stub.max_active, 'at once', flush=True)
+    finally:
+        stub.stop()
+
+    print('LMI', np.round(results[0]['LMI'].values, 4), flush=True)
+    same = np.allclose(results[0]['LMI'].values, results[args.prefetch]['LMI'].values, equal_nan=True)
+    overlapped = args.prefetch < 2 or stub.max_active > 1
+    print('same results' if same else 'different results', flush=True)
+    if not overlapped:
+        print('the downloads did not overlap', flush=True)
+
+    if not (same and overlapped):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
 # Imports necessary for the example
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Point
+
+# Run from the root of the repository so LMI.py can be imported
+from LMI import LMI, LMI_arrays
 
 # Example usage of the Mobility Localness Index (MLI) Calculation Tool
 # This script demonstrates how to use the LMI function with a set of user-defined stop points, home location, and work location.
@@ -18,18 +20,21 @@ stop_points_df = pd.DataFrame({
 })
 
 # Additional parameters
-buffer_size = 0.1  # degrees (approximate, check for accurate unit)
+buffer_size = 1000  # meters
 max_dist_nonPOIstops = 50000  # meters
-threshold_poi = 0.0025  # degrees (approximate, check for accurate unit)
-
-# Create a new column in the DataFrame for the geometry
-stop_points_df['geometry'] = stop_points_df.apply(lambda row: Point(row['x'], row['y']), axis=1)
+threshold_poi = 250  # meters
 
-# Create a GeoDataFrame with the specified coordinate reference system (CRS)
-stop_points = gpd.GeoDataFrame(stop_points_df, geometry='geometry', crs='EPSG:4326')
+# Create a GeoDataFrame with the specified coordinate reference system (CRS), the points are built from the x and y columns at once
+stop_points = gpd.GeoDataFrame(stop_points_df, geometry=gpd.points_from_xy(stop_points_df['x'], stop_points_df['y']), crs='EPSG:4326')
 
 # Call the LMI function with the defined parameters
-localness_value = LMI(stop_points, home_location, threshold_poi, max_dist_nonPOIstops, work_location, buffer_size=buffer_size)
+localness_value = LMI(stop_points, home_location, threshold_poi, max_dist_nonPOIstops, work_location, networkBufferAreaSize=buffer_size)
 
 # Output the result
 print(f"Calculated Mobility Localness Index: {localness_value}")
+
+# The same stop points can also be given as plain arrays, without building a GeoDataFrame
+localness_value = LMI_arrays(stop_points_df['x'].values, stop_points_df['y'].values, stop_points_df['t'].values, 'EPSG:4326',
+                             home_location, threshold_poi, max_dist_nonPOIstops, work_location, networkBufferAreaSize=buffer_size)
+
+print(f"Calculated Mobility Localness Index from arrays: {localness_value}")
@@ -1,44 +1,51 @@
-def LMI(stop_points, home_location, poiCutoff, nonPoiMaxDistance, second_place = -1, networkBufferAreaSize = None, POITypeList = None, pois = None):
-    
-    # importing packages
-    
-    import networkx as nx
-    import osmnx as ox
-    import pandana as pdna
-    import pandas as pd
-    import numpy as np
-    import geopandas as gpd
-    from shapely.geometry import Point, LineString, Polygon
-    from datetime import datetime, timedelta, time
-    from geopy.distance import geodesic
-    from geopy.distance import distance
-    from scipy.spatial.distance import cdist
+# Function to get the UTM zone for a given latitude and longitude
+def _get_utm_zone(lon, lat):
+    utm_band = str(int((lon + 180) / 6) % 60 + 1)
+    if len(utm_band) == 1:
+        utm_band = '0' + utm_band
+    if lat >= 0:
+        return '326' + utm_band
+    else:
+        return '327' + utm_band
+
+
+# Function to check if an object is a tuple of two numbers
+def _is_numeric_tuple(obj):
     import numbers
-    from pyproj import Transformer, CRS
-    
-    # Check if stop__points is a GeoDataFrame with known CRS
-    if not isinstance(stop_points, gpd.GeoDataFrame) or stop_points.crs is None:
-        raise ValueError("Stop Points must be a GeoDataFrame with a known CRS.")
-        
-    if stop_points.empty:
-        raise ValueError("Stop Points must not be empty")
 
-    # Function to check if an object is a tuple of two numbers
-    def is_numeric_tuple(obj):
-        return isinstance(obj, tuple) and len(obj) == 2 and all(isinstance(n, numbers.Number) for n in obj)
+    return isinstance(obj, tuple) and len(obj) == 2 and all(isinstance(n, numbers.Number) for n in obj)
+
+
+# Function to check if a value is numerical or None
+def _is_numeric_or_none(value):
+    import numbers
+
+    return value is None or isinstance(value, numbers.Number)
+
+
+def _check_locations(home_location, second_place):
 
     # Check if home_location and second_place are tuples of two numbers
-    if not is_numeric_tuple(home_location):
+    if not _is_numeric_tuple(home_location):
         raise ValueError("Home Location must be a tuple of two numerical values.")
-    if second_place != -1 and not is_numeric_tuple(second_place):
+    if second_place != -1 and not _is_numeric_tuple(second_place):
         raise ValueError("Second Place must be a tuple of two numerical values or -1.")
 
-    # Function to check if a value is numerical or None
-    def is_numeric_or_none(value):
-        return value is None or isinstance(value, numbers.Number)
+
+def _check_parameters(stop_points, poiCutoff, nonPoiMaxDistance, networkBufferAreaSize, POITypeList, pois):
+
+    import geopandas as gpd
+
+    # Check if stop__points is a GeoDataFrame with known CRS, None when they are given as arrays
+    if stop_points is not None:
+        if not isinstance(stop_points, gpd.GeoDataFrame) or stop_points.crs is None:
+            raise ValueError("Stop Points must be a GeoDataFrame with a known CRS.")
+
+        if stop_points.empty:
+            raise ValueError("Stop Points must not be empty")
 
     # Check if the other parameters are numerical or their default values
-    if not all(is_numeric_or_none(value) for value in [poiCutoff, nonPoiMaxDistance, networkBufferAreaSize]):
+    if not all(_is_numeric_or_none(value) for value in [poiCutoff, nonPoiMaxDistance, networkBufferAreaSize]):
         raise ValueError("poiCutoff, nonPoiMaxDistance, and networkBufferAreaSize must be numerical or None/default.")
 
     # Check if POITypeList is a list containing only string values
@@ -53,624 +60,2197 @@ def LMI(stop_points, home_location, poiCutoff, nonPoiMaxDistance, second_place =
         if 'geometry' not in pois.columns or 'amenity' not in pois.columns:
             raise ValueError("pois must contain 'geometry' and 'amenity' columns")
 
-    # The analogy and some pre defined variables, tranforming the crs
-    
-    work_location = second_place
 
-    main_crs_temp = stop_points.crs
+# Checks the stop points given as arrays and returns them as float arrays
+def _check_arrays(x, y, t, crs, poiCutoff, nonPoiMaxDistance):
+
+    import numpy as np
+
+    if crs is None:
+        raise ValueError("The CRS of the stop points must be known.")
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    t = np.asarray(t, dtype=float)
+
+    if x.ndim != 1 or x.shape != y.shape or x.shape != t.shape:
+        raise ValueError("x, y and t must be one dimensional arrays of the same length.")
+
+    if len(x) == 0:
+        raise ValueError("Stop Points must not be empty")
+
+    if not all(_is_numeric_or_none(value) for value in [poiCutoff, nonPoiMaxDistance]):
+        raise ValueError("poiCutoff and nonPoiMaxDistance must be numerical or None/default.")
+
+    return x, y, t
+
+
+# The coordinates of the stop points as arrays
+def _stop_arrays(stop_points):
+
+    return stop_points.geometry.x.values, stop_points.geometry.y.values
+
+
+# Transformers are expensive to create, the same ones are used for all the stop points
+_transformers = {}
+
+
+def _get_transformer(crs_from, crs_to):
+
+    from pyproj import Transformer
+
+    key = (crs_from, crs_to)
+    if key not in _transformers:
+        _transformers[key] = Transformer.from_crs(crs_from, crs_to, always_xy=True)
+
+    return _transformers[key]
+
+
+# Content addressed on disk cache for the OSM network and amenity downloads
+class OSMCache:
+
+    # bump it whenever the layout of the stored entries changes
+    version = 1
+
+    def __init__(self, directory, max_size = None, offline = False):
+
+        import os
+
+        # max_size is in bytes, the least recently used entries are removed once the cache gets bigger
+        # offline replays the stored entries only and never downloads
+        self.directory = os.fspath(directory)
+        self.max_size = max_size
+        self.offline = offline
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, kind, polygon, **params):
+
+        import hashlib
+        import json
+        from shapely import wkt
+
+        # the polygon is rounded so the same buffer computed twice gives the same key
+        content = json.dumps({
+            'version': self.version,
+            'kind': kind,
+            'polygon': wkt.dumps(polygon, rounding_precision=7),
+            'params': params,
+        }, sort_keys=True, default=str)
+
+        return kind + '-' + hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+
+        import os
+
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+
+        import os
+        import numpy as np
+
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except FileNotFoundError:
+            # missing, or evicted by another thread or process sharing the cache
+            if self.offline:
+                raise LookupError("'" + key + "' is not in the cache and the cache is offline.")
+            return None
+
+        # mark the entry as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        return arrays
+
+    def save(self, key, arrays):
+
+        import os
+        import tempfile
+        import numpy as np
+
+        # write to a temporary file first so a crashed run never leaves a broken entry behind
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        self._evict()
+
+    def _evict(self):
+
+        import os
+
+        if self.max_size is None:
+            return
+
+        # the entries can be removed at the same time by another thread or process sharing the cache
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        # remove the least recently used entries first
+        entries.sort()
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+# Digest of the content of numpy arrays, used to key the cache entries derived from other entries
+def _array_digest(*arrays):
+
+    import hashlib
+    import numpy as np
+
+    digest = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str(array.dtype).encode('utf-8'))
+        digest.update(str(array.shape).encode('utf-8'))
+        digest.update(array.tobytes())
+
+    return digest.hexdigest()
+
+
+def _get_cache(cache):
+
+    import os
+
+    if cache is None or isinstance(cache, OSMCache):
+        return cache
+    if isinstance(cache, (str, os.PathLike)):
+        return OSMCache(cache)
+    raise TypeError("cache must be an OSMCache, a directory path or None")
+
+
+# Network and amenities read from a local OSM XML or PBF extract instead of Overpass, the extract is read once
+# and the network and the amenities of every buffer polygon are clipped from it
+class OSMExtract:
+
+    def __init__(self, path):
+
+        import os
+        import threading
+
+        self.path = os.fspath(path)
+        self.arrays = None
+        self.amenities = None
+
+        # the extract is shared by the threads that prefetch the regions, only the first one reads it
+        self.lock = threading.Lock()
+
+        if not os.path.exists(self.path):
+            raise ValueError("'" + self.path + "' does not exist.")
+
+    @classmethod
+    def from_arrays(cls, osmid, x, y, u, v, length, amenities = None):
+
+        import threading
+        import numpy as np
+
+        # an extract held in memory, for example a synthetic network, given as the arrays of the nodes in WGS 84
+        # and of the edges, and a dict of the osmid, amenity, x and y arrays of the amenity nodes
+        extract = cls.__new__(cls)
+        extract.path = None
+        extract.lock = threading.Lock()
+        extract.arrays = {
+            'osmid': np.asarray(osmid, dtype='int64'),
+            'x': np.asarray(x, dtype='float64'),
+            'y': np.asarray(y, dtype='float64'),
+            'u': np.asarray(u, dtype='int64'),
+            'v': np.asarray(v, dtype='int64'),
+            'length': np.asarray(length, dtype='float64'),
+        }
+
+        if amenities is None:
+            amenities = {'osmid': [], 'amenity': [], 'x': [], 'y': []}
+        extract.amenities = {
+            'osmid': np.asarray(amenities['osmid'], dtype='int64'),
+            'amenity': np.asarray(amenities['amenity'], dtype=str),
+            'x': np.asarray(amenities['x'], dtype='float64'),
+            'y': np.asarray(amenities['y'], dtype='float64'),
+        }
 
-    # Function to get the UTM zone for a given latitude and longitude
-    def get_utm_zone(lon, lat):
-        utm_band = str(int((lon + 180) / 6) % 60 + 1)
-        if len(utm_band) == 1:
-            utm_band = '0' + utm_band
-        if lat >= 0:
-            return '326' + utm_band
+        return extract
+
+    def _read(self):
+
+        import numpy as np
+
+        if self.arrays is not None:
+            return
+
+        if self.path.endswith('.pbf'):
+            try:
+                import pyrosm
+            except ImportError:
+                raise ImportError("pyrosm is required to read PBF extracts.")
+
+            osm = pyrosm.OSM(self.path)
+
+            nodes, edges = osm.get_network(network_type='all', nodes=True)
+            self.arrays = {
+                'osmid': nodes['id'].values.astype('int64'),
+                'x': nodes['lon'].values.astype('float64'),
+                'y': nodes['lat'].values.astype('float64'),
+                'u': edges['u'].values.astype('int64'),
+                'v': edges['v'].values.astype('int64'),
+                'length': edges['length'].values.astype('float64'),
+            }
+            del nodes, edges
+
+            geometries = osm.get_pois(custom_filter={'amenity': True})
+            if geometries is not None and len(geometries) > 0:
+                geometries = geometries[geometries['osm_type'] == 'node']
+                osmids = geometries['id'].values
+            else:
+                osmids = []
         else:
-            return '327' + utm_band
+            import osmnx as ox
+
+            G = ox.graph_from_xml(self.path, simplify=False, retain_all=True)
+
+            # osmnx makes an edge of every way of the extract, only the streets kept by the network_type="all" filter
+            # of the Overpass downloads are kept, not the buildings, waterways or landuse outlines
+            excluded = {'abandoned', 'construction', 'no', 'planned', 'platform', 'proposed', 'raceway', 'razed'}
+            G.remove_edges_from([(u, v, k) for u, v, k, data in G.edges(keys=True, data=True)
+                                 if 'highway' not in data or data['highway'] in excluded or data.get('area') == 'yes'])
+            G.remove_nodes_from([node for node, degree in dict(G.degree()).items() if degree == 0])
+            G = ox.simplify_graph(G)
+
+            self.arrays = _graph_arrays(G)
+            del G
+
+            geometries = ox.geometries.geometries_from_xml(self.path, tags={'amenity': True})
+            if 'amenity' in geometries.columns:
+                geometries = geometries[geometries['amenity'].notna()]
+                geometries = geometries.loc[geometries.index.get_level_values('element_type') == 'node']
+                osmids = geometries.index.get_level_values('osmid').values
+            else:
+                osmids = []
+
+        # the amenity nodes, like the ones downloaded from Overpass
+        if len(osmids) > 0:
+            self.amenities = {
+                'osmid': np.asarray(osmids, dtype='int64'),
+                'amenity': geometries['amenity'].values.astype(str),
+                'x': geometries.geometry.x.values,
+                'y': geometries.geometry.y.values,
+            }
+        else:
+            self.amenities = {'osmid': np.empty(0, dtype='int64'), 'amenity': np.empty(0, dtype=str), 'x': np.empty(0), 'y': np.empty(0)}
 
-    # Transform the GeoDataFrame to WGS 84
-    gdf_wgs84 = stop_points.to_crs(epsg=4326)
+    def network(self, polygon):
 
-    # Determine UTM zone for transformation
-    centroid = gdf_wgs84.geometry.unary_union.centroid
-    utm_crs = CRS.from_epsg(get_utm_zone(centroid.x, centroid.y))
+        import numpy as np
+        import pandas as pd
+        import shapely
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+
+        with self.lock:
+            self._read()
+        arrays = self.arrays
+
+        # the edges between the nodes inside the polygon, and the nodes they connect so that the nodes that are not
+        # on the network, like the amenities of the extract, are left out
+        inside = shapely.contains_xy(polygon, arrays['x'], arrays['y'])
+        node_index = pd.Index(arrays['osmid'][inside])
+        edge_inside = pd.Index(arrays['u']).isin(node_index) & pd.Index(arrays['v']).isin(node_index)
+
+        inside &= pd.Index(arrays['osmid']).isin(arrays['u'][edge_inside]) | pd.Index(arrays['osmid']).isin(arrays['v'][edge_inside])
+
+        # only the largest connected component is kept, like graph_from_polygon does for the downloaded networks, so the
+        # stop points are not snapped to pieces of the network cut off from the rest
+        if edge_inside.any():
+            node_index = pd.Index(arrays['osmid'][inside])
+            u = node_index.get_indexer(arrays['u'][edge_inside])
+            v = node_index.get_indexer(arrays['v'][edge_inside])
+            graph = coo_matrix((np.ones(len(u)), (u, v)), shape=(len(node_index), len(node_index)))
+            _, labels = connected_components(graph, directed=True, connection='weak')
+            largest = labels == np.bincount(labels).argmax()
+
+            inside[inside] = largest
+            edge_inside[edge_inside] = largest[u]
+
+        nodes = pd.DataFrame({'x': arrays['x'][inside], 'y': arrays['y'][inside]}, index=pd.Index(arrays['osmid'][inside], name='osmid'))
+        edges = pd.DataFrame({'u': arrays['u'][edge_inside], 'v': arrays['v'][edge_inside], 'length': arrays['length'][edge_inside]})
+
+        return nodes, edges
+
+    def pois(self, polygon, POITypeList = None):
+
+        import pandas as pd
+        import geopandas as gpd
+        import shapely
+
+        with self.lock:
+            self._read()
+        arrays = self.amenities
+
+        keep = shapely.contains_xy(polygon, arrays['x'], arrays['y'])
+        if POITypeList is not None:
+            keep &= pd.Index(arrays['amenity']).isin(POITypeList)
+
+        index = pd.MultiIndex.from_arrays([['node'] * int(keep.sum()), arrays['osmid'][keep]], names=['element_type', 'osmid'])
+
+        return gpd.GeoDataFrame({'amenity': arrays['amenity'][keep]}, geometry=gpd.points_from_xy(arrays['x'][keep], arrays['y'][keep]),
+                                index=index, crs='EPSG:4326')
+
+
+def _get_source(source):
+
+    import os
+
+    if source is None or isinstance(source, OSMExtract):
+        return source
+    if isinstance(source, (str, os.PathLike)):
+        return OSMExtract(source)
+    raise TypeError("source must be an OSMExtract, the path of an OSM extract or None")
+
+
+# Wall time and counts of the stages of the LMI computation, collected when it is passed to LMI
+class LMIStats:
+
+    def __init__(self, callback = None):
+
+        # callback is called with the name and the wall time of every stage when it ends,
+        # for example to export them to a metrics pipeline
+        self.times = {}
+        self.calls = {}
+        self.counts = {}
+        self.callback = callback
+
+        # peak resident memory of the process in bytes, read at the end of every stage
+        self.peak_memory = None
+
+    def stage(self, name):
+
+        import time
+        import contextlib
+
+        @contextlib.contextmanager
+        def timer():
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.add_time(name, time.perf_counter() - start)
+                self.record_memory()
+
+        return timer()
+
+    def record_memory(self):
+
+        import sys
+
+        try:
+            import resource
+        except ImportError:
+            # not available on Windows
+            return
+
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            peak *= 1024
+
+        self.peak_memory = peak if self.peak_memory is None else max(self.peak_memory, peak)
+
+    def add_time(self, name, seconds, calls = 1):
+
+        self.times[name] = self.times.get(name, 0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + calls
+
+        if self.callback is not None:
+            self.callback(name, seconds)
 
-    # Transform to UTM CRS
-    stop_points = gdf_wgs84.to_crs(utm_crs)
+    def count(self, name, value):
 
-    #transform home and work location to utm
-    
-    lat, lon = home_location[1], home_location[0]
-    
-    point = Point(lat, lon)
+        self.counts[name] = self.counts.get(name, 0) + value
 
-    # Create a GeoDataFrame with the point
-    home_location_gdf = gpd.GeoDataFrame(geometry=[point])
+    def merge(self, other):
 
-    home_location_gdf.set_crs(main_crs_temp, inplace=True)
+        for name in other.times:
+            self.add_time(name, other.times[name], other.calls[name])
+        for name, value in other.counts.items():
+            self.count(name, value)
+        if other.peak_memory is not None:
+            self.peak_memory = other.peak_memory if self.peak_memory is None else max(self.peak_memory, other.peak_memory)
 
-    home_location_gdf = home_location_gdf.to_crs(utm_crs)
+    def as_dict(self):
 
-    if work_location != -1: 
-    
-        lat, lon = work_location[1], work_location[0]
-    
-        point = Point(lat, lon)
-    
-        # Create a GeoDataFrame with the point
-        work_location_gdf = gpd.GeoDataFrame(geometry=[point])
-    
-        work_location_gdf.set_crs(main_crs_temp, inplace=True)
+        return {'times': dict(self.times), 'calls': dict(self.calls), 'counts': dict(self.counts), 'peak_memory': self.peak_memory}
 
-        work_location_gdf = work_location_gdf.to_crs(utm_crs)
 
-    home_location = (home_location_gdf.geometry.iloc[0].x, home_location_gdf.geometry.iloc[0].y)
-    work_location = (work_location_gdf.geometry.iloc[0].x, work_location_gdf.geometry.iloc[0].y)
+def _stage(stats, name):
 
-    main_crs = stop_points.crs
-    
-    user_id= 0
-    
-    # donwloading the network
+    import contextlib
 
-    gdf = stop_points.copy()
+    if stats is None:
+        return contextlib.nullcontext()
+    return stats.stage(name)
 
 
-    # Compute the convex hull
-    convex_hull = gdf.unary_union.convex_hull
+def _count(stats, name, value):
 
-    if networkBufferAreaSize != None:
-        # Add a 5km buffer
-        buffer_polygon = convex_hull.buffer(networkBufferAreaSize)
+    if stats is not None:
+        stats.count(name, value)
 
-        # Change the CRS of buffer back to EPSG:4326 for osmnx and make a geodataframe
-        buffer = gpd.GeoDataFrame(geometry=[buffer_polygon], crs=main_crs).to_crs(epsg=4326)
 
+# The node ids and coordinates and the edges of an osmnx graph as numpy arrays
+def _graph_arrays(G):
+
+    import numpy as np
+
+    node_count = G.number_of_nodes()
+    edge_count = G.number_of_edges()
+
+    arrays = {
+        'osmid': np.fromiter(G.nodes, dtype='int64', count=node_count),
+        'x': np.fromiter((x for _, x in G.nodes(data='x')), dtype='float64', count=node_count),
+        'y': np.fromiter((y for _, y in G.nodes(data='y')), dtype='float64', count=node_count),
+        'u': np.fromiter((u for u, _ in G.edges()), dtype='int64', count=edge_count),
+        'v': np.fromiter((v for _, v in G.edges()), dtype='int64', count=edge_count),
+        'length': np.fromiter((length for _, _, length in G.edges(data='length')), dtype='float64', count=edge_count),
+    }
+
+    return arrays
+
+
+# Send the downloads of the network and the pois to another Overpass server, like a local instance or a stand-in
+# serving fixed responses, which is not rate limited like the public one
+def set_overpass_url(url, rate_limit = False):
+
+    import osmnx as ox
+
+    ox.settings.overpass_url = url.rstrip('/')
+    ox.settings.overpass_rate_limit = rate_limit
+
+
+def _download_network(polygon, network_type = "all", cache = None, stats = None):
+
+    import osmnx as ox
+    import pandas as pd
+
+    with _stage(stats, 'graph_download'):
+        if cache is not None:
+            key = cache.key('network', polygon, network_type=network_type)
+            arrays = cache.load(key)
+        else:
+            arrays = None
+
+        if arrays is None:
+            # Download the network
+            G = ox.graph_from_polygon(polygon, network_type=network_type)
+
+    if arrays is None:
+        with _stage(stats, 'graph_to_arrays'):
+            # only the columns needed for pandana are read from the graph, without building the
+            # geometries and the other attributes of the edges like graph_to_gdfs does
+            arrays = _graph_arrays(G)
+
+            # the graph is not needed anymore
+            del G
+
+        if cache is not None:
+            cache.save(key, arrays)
+
+    nodes = pd.DataFrame({'x': arrays['x'], 'y': arrays['y']}, index=pd.Index(arrays['osmid'], name='osmid'))
+    edges = pd.DataFrame({'u': arrays['u'], 'v': arrays['v'], 'length': arrays['length']})
+
+    _count(stats, 'nodes', len(nodes))
+    _count(stats, 'edges', len(edges))
+
+    return nodes, edges
+
+
+def _download_pois(polygon, POITypeList = None, cache = None, stats = None):
+
+    with _stage(stats, 'poi_download'):
+        return _load_pois(polygon, POITypeList, cache)
+
+
+def _load_pois(polygon, POITypeList = None, cache = None):
+
+    import osmnx as ox
+    import pandas as pd
+    import geopandas as gpd
+
+    # Specify the desired tags for amenities
+    tags = {'amenity': True}
+
+    if cache is not None:
+        key = cache.key('pois', polygon, tags=tags, POITypeList=sorted(POITypeList) if POITypeList is not None else None)
+        arrays = cache.load(key)
     else:
-        buffer = convex_hull
-
-    # Download the network
-    G = ox.graph_from_polygon(buffer.geometry[0], network_type="all")
-
-    # Convert the network to GeoDataFrames
-    nodes, edges = ox.graph_to_gdfs(G, nodes=True, edges=True)
-
-    # Reset index of edges DataFrame
-    edges = edges.reset_index()
-    
-    
-    if pois is None:
-        # Specify the desired tags for amenities
-        tags = {'amenity': True}
-    
+        arrays = None
+
+    if arrays is None:
         # Download amenities within the polygon using OSMnx
-        geometries = ox.geometries.geometries_from_polygon(buffer.geometry[0], tags=tags)
-    
+        geometries = ox.geometries.geometries_from_polygon(polygon, tags=tags)
+
         # Convert the geometries to a GeoDataFrame
         pois = gpd.GeoDataFrame(geometries)
-    
+
         # Filter the DataFrame to keep only the nodes
         pois = pois[pois.index.get_level_values('element_type') == 'node']
-        
+
         # Filter based on the user's list
         if POITypeList is not None:
             pois = pois[pois['amenity'].isin(POITypeList)]
 
-    # Reset the index of the filtered DataFrame
-    destination_gdf = pois.reset_index()
+        if cache is None:
+            return pois
+
+        # only the columns used by LMI are kept
+        arrays = {
+            'osmid': pois.index.get_level_values('osmid').values.astype('int64'),
+            'amenity': pois['amenity'].values.astype(str),
+            'x': pois.geometry.x.values,
+            'y': pois.geometry.y.values,
+        }
 
+        cache.save(key, arrays)
 
-    #copmuting the distance between all pois and all stop points
-    threshold = poiCutoff  # Define the threshold distance
+    index = pd.MultiIndex.from_arrays([['node'] * len(arrays['osmid']), arrays['osmid']], names=['element_type', 'osmid'])
 
+    return gpd.GeoDataFrame({'amenity': arrays['amenity']}, geometry=gpd.points_from_xy(arrays['x'], arrays['y']), crs='EPSG:4326', index=index)
 
-    dist_dfs = []
-    points_for_users = []
-    all_nonPOI_points = []
 
-    distance_crs = main_crs
-    destination_gdf_projected = destination_gdf.to_crs(distance_crs)
+# Shortest path lengths between the pairs of origin and destination nodes, in chunks to bound the memory
+def _shortest_path_lengths(net, origin_nodes, destination_nodes, chunk_size = 100000, stats = None):
 
-    origin_gdf = stop_points.copy()
+    import numpy as np
 
-    # Create network with pandana
-    net = pdna.Network(nodes['x'], nodes['y'], edges['u'], edges['v'], edges[['length']])
+    _count(stats, 'path_queries', len(origin_nodes))
 
-    # Reproject the GeoDataFrames
-    origin_gdf_projected = origin_gdf.to_crs(distance_crs)
+    lengths = np.empty(len(origin_nodes))
+    for start in range(0, len(origin_nodes), chunk_size):
+        end = start + chunk_size
+        lengths[start:end] = net.shortest_path_lengths(origin_nodes[start:end], destination_nodes[start:end])
 
-    # Reshape the coordinate arrays
-    coords_origin = np.column_stack((origin_gdf.geometry.x, origin_gdf.geometry.y))
-    coords_destination = np.column_stack((destination_gdf_projected.geometry.x, destination_gdf_projected.geometry.y))
+    return lengths
 
-    # Calculate distances using cdist()
-    distances = cdist(coords_origin, coords_destination)
 
-    # Find indices of distances below the threshold
-    list_poi_each_stop = []
-    for i in distances:
+# The network as a sparse matrix of the edge lengths, keeping the shortest of parallel edges
+def _csr_graph(node_index, u, v, length):
 
-        indices = np.where(i < threshold)[0]
+    import numpy as np
+    from scipy.sparse import csr_matrix
 
-        if len(indices)>0:
-            min_index = indices[np.argmin(i[indices])]
-            list_poi_each_stop.append(min_index)
-        else:
-            list_poi_each_stop.append([])
+    rows = node_index.get_indexer(u)
+    columns = node_index.get_indexer(v)
 
-    origin_gdf.to_crs("EPSG:4326", inplace=True)
+    order = np.lexsort((length, columns, rows))
+    rows, columns, length = rows[order], columns[order], length[order]
 
-    origin_nodes = net.get_node_ids(origin_gdf['geometry'].x, origin_gdf['geometry'].y).values
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (columns[1:] != columns[:-1])
 
-    results = []
-    count_o = 0
-    for i, origin in origin_gdf.iterrows():
-        flag = True #to check if at least it has one poi nearby
-        #for each node
-        if list_poi_each_stop[count_o]: #check if it's empty
-            destination_node = net.get_node_ids([destination_gdf['geometry'].loc[list_poi_each_stop[count_o]].x], [destination_gdf['geometry'].loc[list_poi_each_stop[count_o]].y]).values
-            origin_node = origin_nodes[count_o]
+    return csr_matrix((length[first], (rows[first], columns[first])), shape=(len(node_index), len(node_index)))
 
-            # Calculate the shortest path length using Pandana
-            path_length = net.shortest_path_length(origin_node, destination_node[0])
 
-            if path_length <= threshold:
-                flag = False #Yes it has at least one poi nearby
-                # Append the result as a dictionary to the list
-                results.append({'origin': i, 'destination': list_poi_each_stop[count_o], 'length': path_length})       
+# Routing backends, both give the network distances between pairs of nodes and from one node to many nodes,
+# with inf for the nodes that can not be reached or are further than the limit
 
+# pandana contraction hierarchy, fast for pairs of different origins and destinations
+class PandanaRouter:
 
-        if flag:
-            all_nonPOI_points.append(origin)
+    # pandana gives the largest unsigned integer in millimeters for the nodes that can not be reached
+    unreachable = 4294967.295
 
-        count_o+=1
+    def __init__(self, net, chunk_size = 100000):
 
-    # Create the DataFrame from the list of dictionaries
-    results_df = pd.DataFrame(results)
-    dist_dfs.append(results_df)
+        self.net = net
+        self.chunk_size = chunk_size
 
-    if len(results_df)>0:
-        #getting all the necessary points to avoid more calculation for home locations
-        points_for_users.append([user_id,list(set(results_df.destination))])
-    else:
-        points_for_users.append([])
+    def pairs(self, origin_nodes, destination_nodes, stats = None):
 
-    if len(all_nonPOI_points)>0:
-        all_nonPOI_points = pd.concat(all_nonPOI_points, axis=1).T
+        import numpy as np
 
-        all_nonPOI_points = gpd.GeoDataFrame(all_nonPOI_points, geometry='geometry')
-        all_nonPOI_points.set_crs("EPSG:4326", inplace=True)
+        lengths = _shortest_path_lengths(self.net, origin_nodes, destination_nodes, self.chunk_size, stats)
+        lengths[lengths >= self.unreachable] = np.inf
 
+        return lengths
 
-    #computing the pois distance to home locations
+    def one_to_many(self, origin_node, destination_nodes, limit = None, stats = None):
 
-    dist_home_dfs = []
+        import numpy as np
 
-    lat, lon = home_location[1], home_location[0]
+        lengths = self.pairs(np.repeat(origin_node, len(destination_nodes)), destination_nodes, stats)
+        if limit is not None:
+            lengths[lengths > limit] = np.inf
 
-    point = Point(lat, lon)
+        return lengths
 
-    # Create a GeoDataFrame with the point
-    origin_gdf = gpd.GeoDataFrame(geometry=[point])
-
-    origin_gdf.set_crs(main_crs, inplace=True)
-
-    # Reshape the coordinate arrays
-    coords_origin = np.column_stack((origin_gdf.geometry.x, origin_gdf.geometry.y))
-    coords_destination = np.column_stack((destination_gdf_projected.geometry.x, destination_gdf_projected.geometry.y))
-
-    # Calculate distances using cdist()
-    distances = cdist(coords_origin, coords_destination)
-
-    # add the distances to the dataframe
-    destination_gdf['distance'] = distances[0]
-
-    # Group the DataFrame by amenity and find the index of the row with the minimum distance
-    closest_rows = destination_gdf.groupby('amenity')['distance'].idxmin()
-
-    # Get the closest rows
-    points_for_users_adjusted_temp = destination_gdf.loc[closest_rows]
-
-    points_for_users_adjusted = list(points_for_users_adjusted_temp.index)
-
-    origin_gdf.to_crs("EPSG:4326", inplace=True)
-
-    # Create a DataFrame with scalar values
-    df_temp = pd.DataFrame({'lat': [origin_gdf.geometry.y], 'lon': [origin_gdf.geometry.x]})
-
-    results = []
-
-    if len(points_for_users_adjusted) != 0:
-
-        # Get the node IDs using the DataFrame
-        origin_nodes = net.get_node_ids(df_temp['lat'], df_temp['lon']).values
-
-        # points that are closest
-        dests_nodes = net.get_node_ids(destination_gdf['geometry'].loc[points_for_users_adjusted].x, destination_gdf['geometry'].loc[points_for_users_adjusted].y).values
-
-        points_for_user = points_for_users[0]
-
-        if len(points_for_user)>0:
-            dests_nodes1 = net.get_node_ids(destination_gdf['geometry'].loc[points_for_user[1]].x, destination_gdf['geometry'].loc[points_for_user[1]].y).values
-            dests_nodes = np.concatenate((dests_nodes, dests_nodes1))
-            points_for_users_adjusted = points_for_users_adjusted + points_for_user[1]
-
-
-        for count, j in enumerate(dests_nodes):
-            # Get the nearest nodes in the graph for the origin and destination points
-            origin_node = origin_nodes[0]
-            destination_node = j
-
-            # Calculate the shortest path length using Pandana
-            path_length = net.shortest_path_length(origin_node, destination_node)
-
-            # Append the result as a dictionary to the list
-            results.append({'origin': user_id, 'destination': points_for_users_adjusted[count], 'length': path_length})
-
-    # Create the DataFrame from the list of dictionaries
-    dist_home_df = pd.DataFrame(results)
-
-    if work_location != -1: 
-        #computing the pois distance to work locations
-    
-        dist_home_dfs = []
-    
-        lat, lon = work_location[1], work_location[0]
-    
-        point = Point(lat, lon)
-    
-        # Create a GeoDataFrame with the point
-        origin_gdf = gpd.GeoDataFrame(geometry=[point])
-    
-        origin_gdf.set_crs(main_crs, inplace=True)
-    
-        # Reshape the coordinate arrays
-        coords_origin = np.column_stack((origin_gdf.geometry.x, origin_gdf.geometry.y))
-        coords_destination = np.column_stack((destination_gdf_projected.geometry.x, destination_gdf_projected.geometry.y))
-    
-        # Calculate distances using cdist()
-        distances = cdist(coords_origin, coords_destination)
-    
-        # add the distances to the dataframe
-        destination_gdf['distance'] = distances[0]
-    
-        # Group the DataFrame by amenity and find the index of the row with the minimum distance
-        closest_rows = destination_gdf.groupby('amenity')['distance'].idxmin()
-    
-        # Get the closest rows
-        points_for_users_adjusted_temp = destination_gdf.loc[closest_rows]
-    
-        points_for_users_adjusted = list(points_for_users_adjusted_temp.index)
-    
-        origin_gdf.to_crs("EPSG:4326", inplace=True)
-    
-        # Create a DataFrame with scalar values
-        df_temp = pd.DataFrame({'lat': [origin_gdf.geometry.y], 'lon': [origin_gdf.geometry.x]})
-    
-        results = []
-    
-        if len(points_for_users_adjusted) != 0:
-    
-            # Get the node IDs using the DataFrame
-            origin_nodes = net.get_node_ids(df_temp['lat'], df_temp['lon']).values
-    
-            # points that are closest
-            dests_nodes = net.get_node_ids(destination_gdf['geometry'].loc[points_for_users_adjusted].x, destination_gdf['geometry'].loc[points_for_users_adjusted].y).values
-    
-            points_for_user = points_for_users[0]
-    
-            if len(points_for_user)>0:
-                dests_nodes1 = net.get_node_ids(destination_gdf['geometry'].loc[points_for_user[1]].x, destination_gdf['geometry'].loc[points_for_user[1]].y).values
-                dests_nodes = np.concatenate((dests_nodes, dests_nodes1))
-                points_for_users_adjusted = points_for_users_adjusted + points_for_user[1]
-    
-    
-            for count, j in enumerate(dests_nodes):
-                # Get the nearest nodes in the graph for the origin and destination points
-                origin_node = origin_nodes[0]
-                destination_node = j
-    
-                # Calculate the shortest path length using Pandana
-                path_length = net.shortest_path_length(origin_node, destination_node)
-    
-                # Append the result as a dictionary to the list
-                results.append({'origin': user_id, 'destination': points_for_users_adjusted[count], 'length': path_length})
-    
-        # Create the DataFrame from the list of dictionaries
-        dist_work_df = pd.DataFrame(results)
-
-
-    #computing the non-pois stop points distance to home locations
-    all_nonPOI_points['distance_to_home'] = [np.nan]*len(all_nonPOI_points)
-
-
-    lat, lon = home_location[1], home_location[0]
-
-    point = Point(lat, lon)
-
-    # Create a DataFrame with scalar values and provide an index
-    df_temp = pd.DataFrame({'lat': [lat], 'lon': [lon]})
-
-    # Get the node IDs using the DataFrame
-    origin_nodes = net.get_node_ids(df_temp['lat'], df_temp['lon']).values
-
-    temp_dest_gdf = all_nonPOI_points
-
-    results = []
-    if len(temp_dest_gdf) != 0:
-
-        dests_nodes = net.get_node_ids(temp_dest_gdf['geometry'].x, temp_dest_gdf['geometry'].y).values
-
-        for count, j in enumerate(dests_nodes):
-            # Get the nearest nodes in the graph for the origin and destination points
-            origin_node = origin_nodes[0]
-            destination_node = j
-
-            # Calculate the shortest path length using Pandana
-            path_length = net.shortest_path_length(origin_node, destination_node)
-
-            # Append the result as a dictionary to the list
-            results.append(path_length)
-
-        all_nonPOI_points.distance_to_home[list(temp_dest_gdf.index)] = results
-
-    if work_location != -1: 
-        #computing the non-pois stop points distance to work locations
-        all_nonPOI_points['distance_to_work'] = [np.nan]*len(all_nonPOI_points)
-
-        lat, lon = work_location[1], work_location[0]
-    
-        point = Point(lat, lon)
-    
-        # Create a DataFrame with scalar values and provide an index
-        df_temp = pd.DataFrame({'lat': [lat], 'lon': [lon]})
-    
-        # Get the node IDs using the DataFrame
-        origin_nodes = net.get_node_ids(df_temp['lat'], df_temp['lon']).values
-    
-        temp_dest_gdf = all_nonPOI_points
-    
-        results = []
-        if len(temp_dest_gdf) != 0:
-    
-            dests_nodes = net.get_node_ids(temp_dest_gdf['geometry'].x, temp_dest_gdf['geometry'].y).values
-    
-            for count, j in enumerate(dests_nodes):
-                # Get the nearest nodes in the graph for the origin and destination points
-                origin_node = origin_nodes[0]
-                destination_node = j
-    
-                # Calculate the shortest path length using Pandana
-                path_length = net.shortest_path_length(origin_node, destination_node)
-    
-                # Append the result as a dictionary to the list
-                results.append(path_length)
-    
-            all_nonPOI_points.distance_to_work[list(temp_dest_gdf.index)] = results
-
-    
-    
-    if work_location == -1:
-        #main section to compute the mobility localness
 
-        #just to have the same analogy for the rest of the code we still call it rank_
+# scipy single source dijkstra over the CSR matrix of the network, one search gives the distance to all the nodes
+# and stops early at the limit, fast from one origin to many destinations
+class DijkstraRouter:
+
+    def __init__(self, node_index, graph):
+
+        self.node_index = node_index
+        self.graph = graph
+
+    def pairs(self, origin_nodes, destination_nodes, stats = None):
+
+        import numpy as np
+
+        # one search for each of the different origins
+        origins, inverse = np.unique(origin_nodes, return_inverse=True)
+        inverse = inverse.ravel()
+
+        lengths = np.empty(len(origin_nodes))
+        for position, origin_node in enumerate(origins):
+            selected = inverse == position
+            lengths[selected] = self.one_to_many(origin_node, destination_nodes[selected], stats=stats)
+
+        return lengths
+
+    def one_to_many(self, origin_node, destination_nodes, limit = None, stats = None):
+
+        import numpy as np
+        from scipy.sparse.csgraph import dijkstra
+
+        _count(stats, 'dijkstra_searches', 1)
+
+        distances = dijkstra(self.graph, directed=False, indices=self.node_index.get_loc(origin_node), limit=limit if limit is not None else np.inf)
+
+        return distances[self.node_index.get_indexer(destination_nodes)]
+
+
+# The buffer around the stop points, and the network and the pois inside it, or the context prepared for the same
+# buffer when it is in the cache. This is the I/O bound part of building a context, it is run in a thread when
+# the next regions are prefetched
+def _fetch_area(x, y, crs, networkBufferAreaSize = None, POITypeList = None, pois = None, cache = None, stats = None, source = None):
+
+    import numpy as np
+    import shapely
+    from pyproj import CRS
+
+    with _stage(stats, 'crs_transform'):
+        # Transform the stop points to WGS 84
+        lon, lat = _get_transformer(crs, 'EPSG:4326').transform(x, y)
+
+        # Determine UTM zone for transformation from the centroid of the stop locations
+        locations = np.unique(np.column_stack((lon, lat)), axis=0)
+        centroid = shapely.multipoints(locations).centroid
+        utm_crs = CRS.from_epsg(_get_utm_zone(centroid.x, centroid.y))
 
-        all_nonPOI_points['rank_'] = 1-(all_nonPOI_points['distance_to_home']/nonPoiMaxDistance)
-        all_nonPOI_points['rank_'] = all_nonPOI_points['rank_'].apply(lambda x: x if x > 0 else 0)
+        # Transform to UTM CRS
+        utm_x, utm_y = _get_transformer('EPSG:4326', utm_crs).transform(lon, lat)
 
-        # Create a dict for amenities and home for using as denominator
-        dicts_keys = set(destination_gdf.amenity)
+        # donwloading the network
 
-        amenity_dict = {value: destination_gdf[destination_gdf.amenity==value].index for value in dicts_keys}
+        # Compute the convex hull
+        convex_hull = shapely.multipoints(np.column_stack((utm_x, utm_y))).convex_hull
 
-        users_localness = []
+        if networkBufferAreaSize != None:
+            # Add a 5km buffer
+            buffer_polygon = convex_hull.buffer(networkBufferAreaSize)
+        else:
+            buffer_polygon = convex_hull
+
+        # Change the CRS of buffer back to EPSG:4326 for osmnx
+        to_wgs84 = _get_transformer(utm_crs, 'EPSG:4326')
+        polygon = shapely.transform(buffer_polygon, lambda coords: np.column_stack(to_wgs84.transform(coords[:, 0], coords[:, 1])))
 
-        results_df = dist_dfs[user_id]
-        results_df_home = dist_home_df
+    cache = _get_cache(cache)
+    source = _get_source(source)
+
+    # the contexts are cached like the downloads they are prepared from, so not for the extracts
+    key = None
+    if cache is not None and source is None:
+        custom_pois = None
+        if pois is not None:
+            custom_pois = [pois.crs.to_string(), _array_digest(pois.geometry.x.values, pois.geometry.y.values, pois['amenity'].values.astype(str))]
+        key = cache.key('context', polygon, version=LMIContext.version, crs=utm_crs.to_epsg(), network_type='all',
+                        POITypeList=sorted(POITypeList) if POITypeList is not None else None, pois=custom_pois)
 
         try:
+            saved = cache.load(key)
+        except LookupError:
+            # the network and the pois may still be in the offline cache
+            saved = None
+
+        if saved is not None:
+            return utm_crs, polygon, None, None, None, key, saved
+
+    if source is not None:
+        # Clip the network and the pois from the local extract
+        with _stage(stats, 'graph_download'):
+            nodes, edges = source.network(polygon)
+
+        _count(stats, 'nodes', len(nodes))
+        _count(stats, 'edges', len(edges))
+
+        if pois is None:
+            with _stage(stats, 'poi_download'):
+                pois = source.pois(polygon, POITypeList)
+    else:
+        # Download the network
+        nodes, edges = _download_network(polygon, network_type="all", cache=cache, stats=stats)
+
+        if pois is None:
+            pois = _download_pois(polygon, POITypeList, cache=cache, stats=stats)
+
+    return utm_crs, polygon, nodes, edges, pois, key, None
+
+
+# The preparation of the area covered by the stop points: the network, the pois and their indexes.
+# It only depends on the area, so it can be built once and used to compute the LMI of every user
+# whose stop points fall inside it.
+class LMIContext:
+
+    # maximum number of origin destination pairs sent to pandana in one query
+    path_chunk_size = 100000
+
+    # the routing backend of the queries from home and work: 'pandana', 'dijkstra', or 'auto' to use dijkstra
+    # once there are more destinations than one for dijkstra_nodes_per_destination nodes of the network
+    routing = 'auto'
+    dijkstra_nodes_per_destination = 500
+
+    # the approximate mode takes the network distances as the straight line distance between the network nodes times
+    # a detour factor, the detour_quantiles of the ratio between both distances over pairs of nodes give the lower,
+    # estimated and upper distance. They are measured by classes of distance (detour_bins, in meters) as the short
+    # trips make the longest detours, from detour_sources searches to detour_targets random nodes
+    detour_quantiles = (0.05, 0.5, 0.95)
+    detour_bins = (0, 250, 500, 1000, 2000, 5000)
+    detour_sources = 16
+    detour_targets = 2000
+
+    # bump it whenever the layout of the saved contexts changes
+    version = 1
+
+    def __init__(self, stop_points, networkBufferAreaSize = None, POITypeList = None, pois = None, cache = None, stats = None, stopTolerance = None, source = None):
+
+        _check_parameters(stop_points, None, None, networkBufferAreaSize, POITypeList, pois)
+
+        x, y = _stop_arrays(stop_points)
+
+        self._setup(x, y, stop_points.crs, networkBufferAreaSize, POITypeList, pois, cache, stats, stopTolerance, source)
+
+    @classmethod
+    def from_arrays(cls, x, y, crs, networkBufferAreaSize = None, POITypeList = None, pois = None, cache = None, stats = None, stopTolerance = None, source = None):
+
+        import numpy as np
+
+        _check_parameters(None, None, None, networkBufferAreaSize, POITypeList, pois)
+
+        x, y, _ = _check_arrays(x, y, np.zeros(np.shape(x)), crs, None, None)
+
+        context = cls.__new__(cls)
+        context._setup(x, y, crs, networkBufferAreaSize, POITypeList, pois, cache, stats, stopTolerance, source)
+
+        return context
+
+    def _setup(self, x, y, crs, networkBufferAreaSize = None, POITypeList = None, pois = None, cache = None, stats = None, stopTolerance = None, source = None):
+
+        if not _is_numeric_or_none(stopTolerance):
+            raise ValueError("stopTolerance must be numerical or None/default.")
+
+        # the size (in meters) under which the stop points are merged before routing, only the repeated locations when None
+        self.stop_tolerance = stopTolerance
+
+        area = _fetch_area(x, y, crs, networkBufferAreaSize, POITypeList, pois, cache, stats, source)
+
+        self._build(area, _get_cache(cache), stats)
+
+    @classmethod
+    def _from_area(cls, area, cache = None, stats = None, stopTolerance = None):
 
-            origin_gdf = stop_points
+        if not _is_numeric_or_none(stopTolerance):
+            raise ValueError("stopTolerance must be numerical or None/default.")
 
-            results_df = results_df.reset_index()
+        # the context of an area that was already fetched by _fetch_area
+        context = cls.__new__(cls)
+        context.stop_tolerance = stopTolerance
+        context._build(area, _get_cache(cache), stats)
 
-            if len(origin_gdf)==1:
-                users_localness.append(1)
+        return context
+
+    def _build(self, area, cache = None, stats = None):
+
+        utm_crs, polygon, nodes, edges, pois, key, saved = area
+
+        # a context found in the cache is only read, the one prepared from the downloads is added to it
+        if saved is not None:
+            self._restore(saved, key, stats)
+            return
+
+        self._prepare(utm_crs, polygon, nodes, edges, pois, cache=cache, stats=stats)
+
+        if key is not None:
+            cache.save(key, self._arrays())
+
+    def _prepare(self, utm_crs, polygon, nodes, edges, pois, cache = None, stats = None, poi_nodes = None):
+
+        import numpy as np
+        import pandas as pd
+        from scipy.spatial import cKDTree
+
+        # Reset the index of the filtered DataFrame
+        destination_gdf = pois.reset_index(drop=True)
+
+        _count(stats, 'pois', len(destination_gdf))
+
+        with _stage(stats, 'network_build'):
+            # the network as a sparse matrix, indexed by the position of the nodes
+            self.node_index = pd.Index(nodes.index)
+            self.graph = _csr_graph(self.node_index, edges['u'].values, edges['v'].values, edges['length'].values)
+
+            # the nodes in WGS 84 to snap the points to the network, the same nearest node search as pandana does
+            self.nodes_lonlat_tree = cKDTree(np.column_stack((nodes['x'].values, nodes['y'].values)))
+
+            # the pandana network and its contraction hierarchy are only built by the first query that needs them,
+            # so a context that is loaded is ready to use without them
+            self.routers = {'dijkstra': DijkstraRouter(self.node_index, self.graph)}
+
+        with _stage(stats, 'crs_transform'):
+            destination_gdf_wgs84 = destination_gdf.to_crs(epsg=4326)
+            destination_gdf_projected = destination_gdf.to_crs(utm_crs)
+
+        self.crs = utm_crs
+        self.polygon = polygon
+        self.nodes = nodes
+        self.edges = edges
+        self.pois = destination_gdf
+
+        # projected coordinates of the pois, used for the euclidean distances
+        self.pois_xy = np.column_stack((destination_gdf_projected.geometry.x, destination_gdf_projected.geometry.y))
+
+        # the pois snapped to the network, stored next to the network so the same network and pois are only snapped once
+        poi_x = destination_gdf_wgs84.geometry.x.values
+        poi_y = destination_gdf_wgs84.geometry.y.values
+
+        with _stage(stats, 'node_snapping'):
+            arrays = {'poi_nodes': poi_nodes} if poi_nodes is not None else None
+            if arrays is None and cache is not None:
+                key = cache.key('poi_nodes', self.polygon, network=_array_digest(nodes.index.values, nodes['x'].values, nodes['y'].values),
+                                pois=_array_digest(poi_x, poi_y))
+                try:
+                    arrays = cache.load(key)
+                except LookupError:
+                    # snapping does not need a download, so it is also done when the cache is offline
+                    arrays = None
+
+            if arrays is not None and len(arrays['poi_nodes']) == len(destination_gdf):
+                self.poi_nodes = arrays['poi_nodes']
             else:
-                # Create a dictionary with values as keys and initialize them with zeros
-                home_dict = {value: np.nan for value in dicts_keys}
-
-                for i in home_dict:
-                    dict_temp = results_df_home[results_df_home.destination.isin(amenity_dict[i])]
-                    if len(dict_temp)>0:
-                        home_dict[i] = dict_temp.length.sort_values().iloc[0]
-
-                # for each stop points
-                stop_point_dist_mean = []
-                list_points_included = []
-                length_pois_ = []
-
-                if len(results_df)>0:
-    
-                    for i, origin in origin_gdf.iterrows():
-    
-                        length_pois = results_df[results_df.origin==i].length
-    
-                        if len(length_pois)>0:
-    
-                            index_poi = results_df.loc[length_pois.idxmin()].destination
-                            type_pois = destination_gdf.loc[index_poi].amenity
-    
-                            length_pois_ = results_df_home[results_df_home.destination==index_poi]
-    
-                            if len(length_pois_)>0:
-    
-                                # actual localness for each stop point
-                                stop_point_dist_temp = 0
-    
-                                try:
-                                    dist_to_home = length_pois_.length.values[0]
-                                    if dist_to_home == 0:
-                                        stop_point_dist_temp = 1
-                                    else:
-                                        stop_point_dist_temp = home_dict[type_pois]/dist_to_home
-    
-                                    list_points_included.append(i)
-    
-                                except:
-                                    pass
-                                #the mean values of localness for all pois around the stop point (we change it but still we kept the name)
-                                stop_point_dist_mean.append(stop_point_dist_temp)
-    
-                    #adding dwell time to the stops
-                    poi_points_dwell_time = origin_gdf['t'][list_points_included]/origin_gdf['t'].sum()
-    
-                    temp_point_for_user = all_nonPOI_points
-                    temp_point_for_user['n_dwell_time'] = temp_point_for_user['t']/origin_gdf['t'].sum()
-    
-    
-                    if len(list_points_included)>0:
-                        users_localness.append((stop_point_dist_mean*poi_points_dwell_time).sum() + (temp_point_for_user.rank_*temp_point_for_user['n_dwell_time']).sum())
-                    else:
-                        users_localness.append(1)
+                if len(destination_gdf) > 0:
+                    self.poi_nodes = self.node_ids(poi_x, poi_y).astype('int64')
                 else:
-                    temp_point_for_user = all_nonPOI_points
-                    temp_point_for_user['n_dwell_time'] = temp_point_for_user['t']/origin_gdf['t'].sum()  
-        
-                    users_localness.append((temp_point_for_user.rank_*temp_point_for_user['n_dwell_time']).sum())
-    
-    
-        except:
-            print('There is an unexpected error')
-            users_localness.append((user_id,np.nan))
-        
-            
-        
-        return users_localness[0]
-    
-    else:
-        
+                    self.poi_nodes = np.empty(0, dtype='int64')
 
-        #main section to compute the mobility localness
+                if cache is not None:
+                    cache.save(key, {'poi_nodes': self.poi_nodes})
+
+        # the amenity of each poi and the indexes of the pois of each amenity
+        self.pois_amenity = destination_gdf['amenity'].values
+        self.amenity_dict = {value: np.flatnonzero(self.pois_amenity == value) for value in set(self.pois_amenity)}
+
+        # spatial index for the closest poi searches
+        with _stage(stats, 'poi_index'):
+            self.pois_tree = cKDTree(self.pois_xy)
 
-        users_localness = []
-        
-        all_nonPOI_points['dist_to_both_min'] = np.minimum(all_nonPOI_points['distance_to_home'], all_nonPOI_points['distance_to_work'])
+        # network distance of each node to the closest poi of each amenity, one column per amenity,
+        # the columns are filled the first time they are needed
+        self.amenities = sorted(self.amenity_dict)
+        self.amenity_columns = {value: column for column, value in enumerate(self.amenities)}
+        self.accessibility = None
+        self.accessibility_computed = np.zeros(len(self.amenities), dtype=bool)
 
+        # the detour factors of the approximate mode and what they need, computed the first time they are used
+        self.detour_factors = None
+        self.node_xy = None
+        self.nodes_tree = None
+        self.amenity_trees = {}
 
-        #just to have the same analogy for the rest of the code we still call it rank_
-        all_nonPOI_points['rank_'] = 1-all_nonPOI_points['dist_to_both_min']/nonPoiMaxDistance
-        all_nonPOI_points['rank_'] = all_nonPOI_points['rank_'] = all_nonPOI_points['rank_'].apply(lambda x: x if x > 0 else 0)
+        # identifies the network and the pois the context was prepared with
+        self.fingerprint = _array_digest(nodes.index.values, nodes['x'].values, nodes['y'].values, edges['u'].values, edges['v'].values,
+                                         edges['length'].values, poi_x, poi_y, self.pois_amenity.astype(str))
 
+    def save(self, path):
 
-        # Create a dict for amenities and home for using as denominator
-        dicts_keys = set(destination_gdf.amenity)
+        import os
+        import tempfile
+        import numpy as np
 
-        amenity_dict = {value: destination_gdf[destination_gdf.amenity==value].index for value in dicts_keys}
+        arrays = self._arrays()
 
-        results_df_work = dist_work_df
-        results_df = dist_dfs[user_id]
-        
-        results_df_home = dist_home_df
+        # write to a temporary file first so a crashed run never leaves a broken file behind
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
         try:
-            origin_gdf = stop_points
-            
-            if len(origin_gdf)==1:
-                users_localness.append(1)
-            else:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
 
-                # Create a dictionary with values as keys and initialize them with zeros
-                home_dict = {value: np.nan for value in dicts_keys}
-
-                for i in home_dict:
-                    dict_temp = results_df_home[results_df_home.destination.isin(amenity_dict[i])]
-                    if len(dict_temp)>0:
-                        home_dict[i] = dict_temp.length.sort_values().iloc[0]
-
-                # Create a dictionary with values as keys and initialize them with zeros
-                work_dict = {value: np.nan for value in dicts_keys}
-
-                if len(results_df_work)>0:
-                    for i in work_dict:
-                        dict_temp = results_df_work[results_df_work.destination.isin(amenity_dict[i])]
-                        if len(dict_temp)>0:
-                            work_dict[i] = dict_temp.length.sort_values().iloc[0]
-                # for each stop points
-                stop_point_dist_mean = []
-                list_points_included = []
-                length_pois_w = []
-                length_pois_h = []
-
-                if len(results_df)>0:
-                    
-                    for i, origin in origin_gdf.iterrows():
-                        
-                        length_pois = results_df[results_df.origin==i].length
-    
-                        if len(length_pois)>0:
-                            index_poi = results_df.loc[length_pois.idxmin()].destination
-                            type_pois = destination_gdf.loc[index_poi].amenity
-    
-                            length_pois_h = results_df_home[results_df_home.destination==index_poi]
-                            if len(results_df_work)>0:
-                                length_pois_w = results_df_work[results_df_work.destination==index_poi]
-    
-                            # actual localness for each stop point
-                            stop_point_dist_temp = 0
-                            try:
-                                flag_w = 0
-                                if len(length_pois_h)>0:
-                                    dist_to_home_work = length_pois_h.length.values[0] #we assessing home first
-    
-                                    if len(results_df_work)>0 and len(length_pois_w)>0:
-                                        dist_to_work = length_pois_w.length.values[0]
-                                    else:
-                                        dist_to_work = dist_to_home_work+1 #just to be bigger than that for the next condition
-    
-                                    if dist_to_work < dist_to_home_work:#we compare and if work was less then work distance will be done we consider
-                                        dist_to_home_work = dist_to_work
-                                        flag_w = 1
-                                else:
-                                    if len(results_df_work)>0 and len(length_pois_w)>0:
-                                        dist_to_home_work = length_pois_w.length.values[0]
-                                        flag_w = 1
-                                    else:
-                                        pass
-    
-                                if dist_to_home_work == 0:
-                                    stop_point_dist_temp = 1
-                                else:
-                                    if flag_w == 0:
-                                        stop_point_dist_temp = (home_dict[type_pois]/dist_to_home_work)
-                                    else:
-                                        stop_point_dist_temp = (work_dict[type_pois]/dist_to_home_work)
-    
-                                list_points_included.append(i)
-    
-                            except:
-                                pass
-
-                            stop_point_dist_mean.append(stop_point_dist_temp)
-    
-                    poi_points_dwell_time = origin_gdf['t'][list_points_included]/origin_gdf['t'].sum()
-    
-                    temp_point_for_user = all_nonPOI_points
-                    temp_point_for_user['n_dwell_time'] = temp_point_for_user['t']/origin_gdf['t'].sum()  
-    
-    
-                    if len(list_points_included)>0:
-                        users_localness.append((stop_point_dist_mean*poi_points_dwell_time).sum() + (temp_point_for_user.rank_*temp_point_for_user['n_dwell_time']).sum())
-                    else:
-                        users_localness.append(1)
-                else:
-                    temp_point_for_user = all_nonPOI_points
-                    temp_point_for_user['n_dwell_time'] = temp_point_for_user['t']/origin_gdf['t'].sum()  
-    
-                    users_localness.append((temp_point_for_user.rank_*temp_point_for_user['n_dwell_time']).sum())
-    
-        except:
-            print('There is an unexpected error')
-            users_localness.append(np.nan)
-        
-        return users_localness[0]
+    def _arrays(self):
+
+        import numpy as np
+        from shapely import wkt
+
+        nodes = self.nodes
+        edges = self.edges
+        pois_wgs84 = self.pois.to_crs(epsg=4326)
+
+        # everything that is needed to prepare the context again without downloading, snapping or computing the accessibility,
+        # pandana can not save its contraction hierarchy so only the network it is built from is saved
+        arrays = {
+            'version': np.array(self.version),
+            'crs': np.array(self.crs.to_epsg()),
+            'polygon': np.array(wkt.dumps(self.polygon)),
+            'stop_tolerance': np.array(self.stop_tolerance if self.stop_tolerance is not None else np.nan, dtype=float),
+            'node_id': nodes.index.values,
+            'x': nodes['x'].values,
+            'y': nodes['y'].values,
+            'u': edges['u'].values,
+            'v': edges['v'].values,
+            'length': edges['length'].values,
+            'poi_x': pois_wgs84.geometry.x.values,
+            'poi_y': pois_wgs84.geometry.y.values,
+            'poi_amenity': self.pois_amenity.astype(str),
+            'poi_nodes': self.poi_nodes,
+            'fingerprint': np.array(self.fingerprint),
+            'accessibility_computed': self.accessibility_computed,
+        }
+        if self.accessibility is not None:
+            arrays['accessibility'] = self.accessibility
+
+        # the digest of all the arrays is checked when the context is loaded
+        arrays['digest'] = np.array(_array_digest(*[arrays[name] for name in sorted(arrays)]))
+
+        return arrays
+
+    @classmethod
+    def load(cls, path, stats = None):
+
+        import numpy as np
+
+        with np.load(path, allow_pickle=False) as entry:
+            arrays = {name: entry[name] for name in entry.files}
+
+        stop_tolerance = float(arrays['stop_tolerance'])
+
+        context = cls.__new__(cls)
+        context.stop_tolerance = None if np.isnan(stop_tolerance) else stop_tolerance
+        context._restore(arrays, path, stats)
+
+        return context
+
+    def _restore(self, arrays, path, stats = None):
+
+        import pandas as pd
+        import geopandas as gpd
+        from pyproj import CRS
+        from shapely import wkt
+
+        arrays = dict(arrays)
+        digest = str(arrays.pop('digest', ''))
+        if digest != _array_digest(*[arrays[name] for name in sorted(arrays)]):
+            raise ValueError("'" + str(path) + "' failed the integrity check.")
+        if int(arrays['version']) != self.version:
+            raise ValueError("'" + str(path) + "' was saved by another version of LMIContext.")
+
+        nodes = pd.DataFrame({'x': arrays['x'], 'y': arrays['y']}, index=pd.Index(arrays['node_id'], name='osmid'))
+        edges = pd.DataFrame({'u': arrays['u'], 'v': arrays['v'], 'length': arrays['length']})
+        pois = gpd.GeoDataFrame({'amenity': arrays['poi_amenity']}, geometry=gpd.points_from_xy(arrays['poi_x'], arrays['poi_y']), crs='EPSG:4326')
+
+        # nothing is downloaded, snapped or built but the sparse matrix of the network
+        self._prepare(CRS.from_epsg(int(arrays['crs'])), wkt.loads(str(arrays['polygon'])), nodes, edges, pois, stats=stats, poi_nodes=arrays['poi_nodes'])
+
+        if self.fingerprint != str(arrays['fingerprint']):
+            raise ValueError("'" + str(path) + "' failed the integrity check.")
+
+        if 'accessibility' in arrays:
+            self.accessibility = arrays['accessibility']
+            self.accessibility_computed = arrays['accessibility_computed']
+
+    # The network node closest to each point given in WGS 84
+    def node_ids(self, lon, lat):
+
+        import numpy as np
+
+        _, positions = self.nodes_lonlat_tree.query(np.column_stack((np.asarray(lon, dtype=float), np.asarray(lat, dtype=float))))
+
+        return self.node_index.values[positions]
+
+    # The pandana backend, its contraction hierarchy is built the first time it is used
+    def pandana_router(self, stats = None):
+
+        import pandana as pdna
+
+        if 'pandana' not in self.routers:
+            with _stage(stats, 'network_build'):
+                net = pdna.Network(self.nodes['x'], self.nodes['y'], self.edges['u'], self.edges['v'], self.edges[['length']])
+            self.routers['pandana'] = PandanaRouter(net, self.path_chunk_size)
+
+        return self.routers['pandana']
+
+    @property
+    def net(self):
+
+        return self.pandana_router().net
+
+    # The routing backend for a query from one origin to a number of destinations
+    def router(self, destinations, stats = None):
+
+        if self.routing == 'auto':
+            if destinations * self.dijkstra_nodes_per_destination >= len(self.node_index):
+                return self.routers['dijkstra']
+            return self.pandana_router(stats)
+
+        if self.routing == 'pandana':
+            return self.pandana_router(stats)
+        if self.routing != 'dijkstra':
+            raise ValueError("routing must be 'auto', 'pandana' or 'dijkstra'.")
+
+        return self.routers['dijkstra']
+
+    def compute_accessibility(self, amenities = None, stats = None):
+
+        import numpy as np
+        from scipy.sparse.csgraph import dijkstra
+
+        if amenities is None:
+            amenities = self.amenities
+
+        if self.accessibility is None:
+            self.accessibility = np.full((len(self.node_index), len(self.amenities)), np.nan, dtype='float32')
+
+        for amenity in set(amenities):
+            column = self.amenity_columns[amenity]
+            if self.accessibility_computed[column]:
+                continue
+
+            with _stage(stats, 'accessibility'):
+                # one search from all the pois of the amenity at once gives the distance to the closest of them
+                sources = np.unique(self.node_index.get_indexer(self.poi_nodes[self.amenity_dict[amenity]]))
+                self.accessibility[:, column] = dijkstra(self.graph, directed=False, indices=sources, min_only=True)
+                self.accessibility_computed[column] = True
+
+    def amenity_distances(self, node, amenities, stats = None):
+
+        import numpy as np
+
+        # network distance of a node to the closest poi of each of the amenities
+        self.compute_accessibility(amenities, stats)
+
+        if len(amenities) == 0:
+            return np.empty(0)
+
+        columns = np.array([self.amenity_columns[amenity] for amenity in amenities])
+
+        return self.accessibility[self.node_index.get_loc(node), columns].astype(float)
+
+    def calibrate_detour(self, stats = None, seed = 0):
+
+        import numpy as np
+        from scipy.spatial import cKDTree
+        from scipy.sparse.csgraph import dijkstra
+
+        if self.detour_factors is not None:
+            return
+
+        with _stage(stats, 'detour_calibration'):
+            # the nodes of the network in the projected crs, in the order of node_index
+            nodes = self.nodes.reindex(self.node_index)
+            self.node_xy = np.column_stack(_get_transformer('EPSG:4326', self.crs).transform(nodes['x'].values, nodes['y'].values))
+            self.poi_node_positions = self.node_index.get_indexer(self.poi_nodes)
+
+            # the points are snapped to the nodes in the projected crs, without the overhead of a pandana query per user
+            self.nodes_tree = cKDTree(self.node_xy)
+
+            rng = np.random.default_rng(seed)
+            sources = rng.choice(len(self.node_index), min(self.detour_sources, len(self.node_index)), replace=False)
+            targets = rng.choice(len(self.node_index), min(self.detour_targets, len(self.node_index)), replace=False)
+
+            network = np.vstack([dijkstra(self.graph, directed=False, indices=source)[targets] for source in sources])
+            straight = np.hypot(self.node_xy[sources, 0][:, None] - self.node_xy[targets, 0], self.node_xy[sources, 1][:, None] - self.node_xy[targets, 1])
+
+            # the pairs that are not connected or at the same place say nothing about the detours
+            keep = np.isfinite(network) & (straight > 0)
+            if not keep.any():
+                raise ValueError("The network is too small to measure its detour factors.")
+
+            ratios = network[keep] / straight[keep]
+            bins = np.searchsorted(self.detour_bins, straight[keep], side='right') - 1
+
+            # the classes of distance with too few pairs take the quantiles of all the pairs
+            factors = np.tile(np.quantile(ratios, self.detour_quantiles), (len(self.detour_bins), 1))
+            for b in range(len(self.detour_bins)):
+                if (bins == b).sum() >= 30:
+                    factors[b] = np.quantile(ratios[bins == b], self.detour_quantiles)
+
+            self.detour_factors = factors
+
+    def _approximate_distances(self, straight):
+
+        import numpy as np
+
+        # the lower, estimated and upper network distance of straight line distances, as three rows
+        factors = self.detour_factors[np.searchsorted(self.detour_bins, straight, side='right') - 1]
+
+        return (straight[:, None] * factors).T
+
+    def _amenity_straight_distances(self, xy, amenities):
+
+        import numpy as np
+        from scipy.spatial import cKDTree
+
+        # straight line distance of a point to the network node of the closest poi of each of the amenities
+        distances = np.empty(len(amenities))
+        for amenity in set(amenities):
+            if amenity not in self.amenity_trees:
+                self.amenity_trees[amenity] = cKDTree(self.node_xy[self.poi_node_positions[self.amenity_dict[amenity]]])
+            distances[amenities == amenity] = self.amenity_trees[amenity].query(xy)[0]
+
+        return distances
+
+    def localness(self, stop_points, home_location, poiCutoff, nonPoiMaxDistance, second_place = -1, stats = None):
+
+        _check_parameters(stop_points, poiCutoff, nonPoiMaxDistance, None, None, None)
+        _check_locations(home_location, second_place)
+
+        x, y = _stop_arrays(stop_points)
+
+        return self._localness(x, y, stop_points['t'].values, stop_points.crs, home_location, poiCutoff, nonPoiMaxDistance, second_place, stats)
+
+    def localness_arrays(self, x, y, t, crs, home_location, poiCutoff, nonPoiMaxDistance, second_place = -1, stats = None):
+
+        x, y, t = _check_arrays(x, y, t, crs, poiCutoff, nonPoiMaxDistance)
+        _check_locations(home_location, second_place)
+
+        return self._localness(x, y, t, crs, home_location, poiCutoff, nonPoiMaxDistance, second_place, stats)
+
+    def _localness(self, x, y, t, crs, home_location, poiCutoff, nonPoiMaxDistance, second_place = -1, stats = None):
+
+        import numpy as np
+
+        # the localness of each stop point, weighted by its dwell time
+        values = self._stop_values(x, y, crs, home_location, poiCutoff, nonPoiMaxDistance, second_place, stats)
+
+        if len(x)==1:
+            return 1
+
+        try:
+            with _stage(stats, 'scoring'):
+                #adding dwell time to the stops
+                t = t.astype(float)
+
+                return np.nansum(values * t) / t.sum()
+
+        except:
+            print('There is an unexpected error')
+            return np.nan
+
+    def localness_approximate(self, stop_points, home_location, poiCutoff, nonPoiMaxDistance, second_place = -1, stats = None):
+
+        _check_parameters(stop_points, poiCutoff, nonPoiMaxDistance, None, None, None)
+        _check_locations(home_location, second_place)
+
+        x, y = _stop_arrays(stop_points)
+
+        return self._localness_approximate(x, y, stop_points['t'].values, stop_points.crs, home_location, poiCutoff, nonPoiMaxDistance, second_place, stats)
+
+    def localness_approximate_arrays(self, x, y, t, crs, home_location, poiCutoff, nonPoiMaxDistance, second_place = -1, stats = None):
+
+        x, y, t = _check_arrays(x, y, t, crs, poiCutoff, nonPoiMaxDistance)
+        _check_locations(home_location, second_place)
+
+        return self._localness_approximate(x, y, t, crs, home_location, poiCutoff, nonPoiMaxDistance, second_place, stats)
+
+    def _localness_approximate(self, x, y, t, crs, home_location, poiCutoff, nonPoiMaxDistance, second_place = -1, stats = None):
+
+        import numpy as np
+
+        values = self._approximate_stop_values(x, y, crs, home_location, poiCutoff, nonPoiMaxDistance, second_place, stats)
+
+        if len(x)==1:
+            return 1, 1, 1
+
+        # the approximate LMI and its lower and upper bound
+        t = t.astype(float)
+        lmi, lower, upper = np.nansum(values * t, axis=1) / t.sum()
+
+        return float(lmi), float(lower), float(upper)
+
+    # Same as _stop_values with the network distances taken from the straight line distances between the network
+    # nodes and the detour factors, returns the estimated, lower and upper localness of each stop point as three rows
+    def _approximate_stop_values(self, x, y, crs, home_location, poiCutoff, nonPoiMaxDistance, second_place = -1, stats = None):
+
+        import numpy as np
+
+        self.calibrate_detour(stats)
+
+        _count(stats, 'stops', len(x))
+
+        anchors = [home_location] if second_place == -1 else [home_location, second_place]
+
+        with _stage(stats, 'crs_transform'):
+            to_utm = _get_transformer(crs, self.crs)
+            coords = np.column_stack(to_utm.transform(x, y))
+            anchor_coords = np.column_stack(to_utm.transform([anchor[0] for anchor in anchors], [anchor[1] for anchor in anchors]))
+
+        first_stops, stop_inverse = self._unique_stops(coords)
+        coords = coords[first_stops]
+
+        _count(stats, 'unique_stops', len(first_stops))
+
+        with _stage(stats, 'nearest_poi'):
+            # the closest poi of each stop point closer than poiCutoff, like in the exact computation
+            _, closest = self.pois_tree.query(coords, distance_upper_bound=poiCutoff)
+            has_poi = closest != len(self.pois_xy)
+            closest = closest[has_poi]
+
+        with _stage(stats, 'node_snapping'):
+            # the distances are measured between the network nodes the stop points and the anchors are snapped to
+            stop_xy = self.node_xy[self.nodes_tree.query(coords)[1]]
+            anchor_xy = self.node_xy[self.nodes_tree.query(anchor_coords)[1]]
+
+        with _stage(stats, 'approximate_scoring'):
+            poi_xy = self.node_xy[self.poi_node_positions[closest]]
+            amenities = self.pois_amenity[closest]
+
+            # the stop points that are poi stops with the estimated distance, and with the lower and upper distance
+            path = np.full((3, len(coords)), np.inf)
+            path[:, has_poi] = self._approximate_distances(np.hypot(*(stop_xy[has_poi] - poi_xy).T))
+            is_poi_stop = path[1] <= poiCutoff
+            maybe_poi_stop = path[0] <= poiCutoff
+            surely_poi_stop = path[2] <= poiCutoff
+
+            # the ratio of the poi stops from each anchor, the anchor closest to the poi is used
+            anchor_ratios = []
+            dist_to_pois = []
+            for xy in anchor_xy:
+                dist_to_poi = self._approximate_distances(np.hypot(*(poi_xy - xy).T))
+                denominators = np.minimum(self._approximate_distances(self._amenity_straight_distances(xy, amenities)), dist_to_poi)
+
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    anchor_ratios.append(np.array([np.where(dist_to_poi[2] == 0, 1, denominators[0] / dist_to_poi[2]),
+                                            np.where(dist_to_poi[1] == 0, 1, denominators[1] / dist_to_poi[1]),
+                                            np.where(dist_to_poi[0] == 0, 1, np.minimum(denominators[2] / dist_to_poi[0], 1))]))
+                dist_to_pois.append(dist_to_poi)
+
+            ratio = anchor_ratios[0]
+            if len(anchors) == 2:
+                # work is used when it is closer to the poi than home, and the bounds cover both when it is not sure
+                flag_w = dist_to_pois[1][1] < dist_to_pois[0][1]
+                home_possible = ~(dist_to_pois[1][2] < dist_to_pois[0][0])
+                work_possible = dist_to_pois[1][0] < dist_to_pois[0][2]
+
+                ratio = np.array([
+                    np.minimum(np.where(home_possible, anchor_ratios[0][0], np.inf), np.where(work_possible, anchor_ratios[1][0], np.inf)),
+                    np.where(flag_w, anchor_ratios[1][1], anchor_ratios[0][1]),
+                    np.maximum(np.where(home_possible, anchor_ratios[0][2], -np.inf), np.where(work_possible, anchor_ratios[1][2], -np.inf)),
+                ])
+
+            ratios = np.full((3, len(coords)), np.nan)
+            ratios[:, has_poi] = ratio
+
+            # the rank of the non-poi stops from the closest of home and work, the upper distance gives the lower rank
+            anchor_distances = np.min([self._approximate_distances(np.hypot(*(stop_xy - xy).T)) for xy in anchor_xy], axis=0)
+            rank_ = np.maximum(1 - anchor_distances[::-1] / nonPoiMaxDistance, 0)
+
+            values = np.array([
+                np.where(surely_poi_stop, ratios[0], np.where(maybe_poi_stop, np.fmin(ratios[0], rank_[0]), rank_[0])),
+                np.where(is_poi_stop, ratios[1], rank_[1]),
+                np.where(surely_poi_stop, ratios[2], np.where(maybe_poi_stop, np.fmax(ratios[2], rank_[2]), rank_[2])),
+            ])
+
+        # the estimated value first, then the lower and upper bound
+        return values[[1, 0, 2]][:, stop_inverse]
+
+    def stop_contributions(self, stop_points, home_location, poiCutoff, nonPoiMaxDistance, second_place = -1, stats = None):
+
+        _check_parameters(stop_points, poiCutoff, nonPoiMaxDistance, None, None, None)
+        _check_locations(home_location, second_place)
+
+        x, y = _stop_arrays(stop_points)
+
+        return self._stop_values(x, y, stop_points.crs, home_location, poiCutoff, nonPoiMaxDistance, second_place, stats)
+
+    def _stop_values(self, x, y, crs, home_location, poiCutoff, nonPoiMaxDistance, second_place = -1, stats = None):
+
+        import numpy as np
+
+        stop_inverse, _, path_lengths, ratios, anchor_distances = self._stop_distances(x, y, crs, home_location, poiCutoff, second_place, stats, limit=nonPoiMaxDistance)
+
+        with _stage(stats, 'scoring'):
+            # the stop points that have at least one poi nearby
+            is_poi_stop = path_lengths <= poiCutoff
+
+            #just to have the same analogy for the rest of the code we still call it rank_
+            rank_ = 1 - anchor_distances / nonPoiMaxDistance
+            rank_ = np.where(rank_ > 0, rank_, 0)
+
+            # the ratio of the poi stops and the rank_ of the non-poi stops, in the order of the stop points
+            values = np.where(is_poi_stop, ratios, rank_)
+
+        return values[stop_inverse]
+
+    def _unique_stops(self, coords):
+
+        import numpy as np
+
+        # Repeated stop locations are computed once and their localness is mapped back to each of their stop points,
+        # with a tolerance the stop points falling in the same cell of a grid of that size are computed at the first of them
+        if self.stop_tolerance is not None:
+            keys = np.floor(coords / self.stop_tolerance)
+        else:
+            keys = coords
+
+        _, first_stops, stop_inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+
+        return first_stops, stop_inverse.ravel()
+
+    # Distances of the unique locations of the stop points: the euclidean and the network distance to their closest poi
+    # closer than poiCutoff, the localness ratio of the poi stops and the distance of the non-poi stops to the closest
+    # of home and work, computed for all the stops when all_stops is True and only up to limit when it is given
+    def _stop_distances(self, x, y, crs, home_location, poiCutoff, second_place = -1, stats = None, all_stops = False, limit = None):
+
+        import numpy as np
+
+        # The analogy and some pre defined variables, tranforming the crs
+
+        work_location = second_place
+
+        main_crs = self.crs
+
+        _count(stats, 'stops', len(x))
+
+        with _stage(stats, 'crs_transform'):
+            # Transform to UTM CRS
+            coords_origin = np.column_stack(_get_transformer(crs, main_crs).transform(x, y))
+
+            #transform home and work location to WGS 84 for the network lookups
+            to_wgs84 = _get_transformer(crs, 'EPSG:4326')
+
+            home_location_lonlat = to_wgs84.transform(home_location[0], home_location[1])
+
+            if work_location != -1:
+
+                work_location_lonlat = to_wgs84.transform(work_location[0], work_location[1])
+
+        #copmuting the distance between all pois and all stop points
+        threshold = poiCutoff  # Define the threshold distance
+
+        first_stops, stop_inverse = self._unique_stops(coords_origin)
+
+        coords_origin = coords_origin[first_stops]
+        x = x[first_stops]
+        y = y[first_stops]
+
+        _count(stats, 'unique_stops', len(first_stops))
+
+        with _stage(stats, 'nearest_poi'):
+            # Find the closest poi of each stop point closer than the threshold, -1 if there is none
+            poi_distances, list_poi_each_stop = self.pois_tree.query(coords_origin, distance_upper_bound=threshold)
+            list_poi_each_stop[list_poi_each_stop == len(self.pois_xy)] = -1
+
+        with _stage(stats, 'crs_transform'):
+            origin_lon, origin_lat = to_wgs84.transform(x, y)
+
+        with _stage(stats, 'node_snapping'):
+            origin_nodes = self.node_ids(origin_lon, origin_lat)
+
+        # Calculate the shortest path length to the closest poi of all the stop points at once
+        has_poi = list_poi_each_stop != -1
+
+        with _stage(stats, 'paths_stops_to_pois'):
+            # the stop locations snapped to the same node with the same closest poi share their path
+            pairs, pair_inverse = np.unique(np.column_stack((origin_nodes[has_poi], list_poi_each_stop[has_poi])), axis=0, return_inverse=True)
+
+            path_lengths = np.full(len(coords_origin), np.inf)
+            path_lengths[has_poi] = self.pandana_router(stats).pairs(pairs[:, 0], self.poi_nodes[pairs[:, 1]], stats)[pair_inverse.ravel()]
+
+        # the stop points that have at least one poi nearby
+        is_poi_stop = path_lengths <= threshold
+
+        # the poi of each poi stop
+        index_pois = list_poi_each_stop[is_poi_stop]
+
+        # the stop points whose distance to home and work is needed
+        anchor_stops = np.ones(len(coords_origin), dtype=bool) if all_stops else ~is_poi_stop
+        all_nonPOI_nodes, nonPOI_inverse = np.unique(origin_nodes[anchor_stops], return_inverse=True)
+
+        # the amenity of each poi stop
+        type_pois = self.pois_amenity[index_pois]
+
+        #getting all the necessary points to avoid more calculation for home locations
+        stop_pois = np.unique(index_pois)
+
+        # Function to compute the distance of an anchor (home or work) location to the poi of each poi stop, to the closest
+        # poi of the same amenity which is used as denominator, and to the non-pois stop points
+        def anchor_distances(anchor_location_lonlat):
+
+            # Get the node IDs of the anchor location
+            with _stage(stats, 'node_snapping'):
+                anchor_node = self.node_ids([anchor_location_lonlat[0]], [anchor_location_lonlat[1]])[0]
+
+            # Calculate the shortest path lengths to the pois and to the non-pois stop points in one query, the search
+            # can stop at the limit when only the non-pois stop points are needed
+            destinations = np.concatenate((self.poi_nodes[stop_pois], all_nonPOI_nodes))
+            router = self.router(len(destinations), stats)
+
+            distances = router.one_to_many(anchor_node, destinations, limit if len(stop_pois) == 0 else None, stats)
+
+            dist_to_pois = distances[:len(stop_pois)][np.searchsorted(stop_pois, index_pois)]
+
+            # the closest poi of the amenity can not be further than the poi of the stop itself
+            denominators = np.minimum(self.amenity_distances(anchor_node, type_pois, stats), dist_to_pois)
+
+            dist_to_nonPOIs = distances[len(stop_pois):][nonPOI_inverse]
+
+            return dist_to_pois, denominators, dist_to_nonPOIs
+
+        #computing the pois and the non-pois stop points distance to home locations
+        with _stage(stats, 'paths_home'):
+            dist_to_home_work, denominators, distance_to_home = anchor_distances(home_location_lonlat)
+
+        if work_location != -1:
+            #computing the pois and the non-pois stop points distance to work locations
+            with _stage(stats, 'paths_work'):
+                dist_to_work, work_denominators, distance_to_work = anchor_distances(work_location_lonlat)
+
+        #main section to compute the mobility localness
+
+        with _stage(stats, 'scoring'):
+            dist_to_both_min = distance_to_home
+
+            if work_location != -1:
+                #we compare and if work was less then work distance will be done we consider
+                flag_w = dist_to_work < dist_to_home_work
+                dist_to_home_work = np.where(flag_w, dist_to_work, dist_to_home_work)
+                denominators = np.where(flag_w, work_denominators, denominators)
+
+                dist_to_both_min = np.minimum(distance_to_home, distance_to_work)
+
+            # actual localness for each poi stop
+            with np.errstate(divide='ignore', invalid='ignore'):
+                stop_point_dist_mean = np.where(dist_to_home_work == 0, 1, denominators / dist_to_home_work)
+
+            ratios = np.full(len(coords_origin), np.nan)
+            ratios[is_poi_stop] = stop_point_dist_mean
+
+            anchor_distances = np.full(len(coords_origin), np.nan)
+            anchor_distances[anchor_stops] = dist_to_both_min
+
+        return stop_inverse, poi_distances, path_lengths, ratios, anchor_distances
+
+    def localness_windows(self, stop_points, home_location, poiCutoff, nonPoiMaxDistance, time_column, window, step = None, second_place = -1, stats = None):
+
+        import numpy as np
+        import pandas as pd
+
+        if time_column not in stop_points.columns:
+            raise ValueError("Stop Points must contain the '" + str(time_column) + "' column.")
+
+        window = pd.Timedelta(window)
+        step = pd.Timedelta(step) if step is not None else window
+
+        if window <= pd.Timedelta(0) or step <= pd.Timedelta(0):
+            raise ValueError("window and step must be positive durations.")
+
+        # the localness of each stop point is computed once, and shared by all the windows it falls in
+        values = self.stop_contributions(stop_points, home_location, poiCutoff, nonPoiMaxDistance, second_place, stats)
+
+        with _stage(stats, 'windows'):
+            times = pd.to_datetime(stop_points[time_column]).values
+            t = stop_points['t'].values.astype(float)
+
+            order = np.argsort(times, kind='stable')
+            times = times[order]
+
+            # running totals of the weighted localness, of the dwell time and of the stop points, so the
+            # totals of a window are the difference of the running totals at its two ends
+            weighted = np.concatenate(([0], np.cumsum(np.nan_to_num(values[order] * t[order]))))
+            total = np.concatenate(([0], np.cumsum(t[order])))
+            count = np.arange(len(times) + 1)
+
+            # every window containing at least one stop point, from the first that ends after the first stop point to
+            # the last that starts before the last one
+            starts = pd.date_range((pd.Timestamp(times[0]) - window + step).floor(step), pd.Timestamp(times[-1]), freq=step)
+            ends = starts + window
+
+            first = np.searchsorted(times, starts.values, side='left')
+            last = np.searchsorted(times, ends.values, side='left')
+
+            stops = count[last] - count[first]
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                localness = (weighted[last] - weighted[first]) / (total[last] - total[first])
+
+            localness = np.where(stops == 1, 1, np.where(stops == 0, np.nan, localness))
+
+        return pd.DataFrame({'start': starts, 'end': ends, 'stops': stops, 'LMI': localness})
+
+    def localness_sweep(self, stop_points, home_location, poiCutoffs, nonPoiMaxDistances, second_place = -1, stats = None):
+
+        import numpy as np
+        import pandas as pd
+
+        poiCutoffs = np.asarray(poiCutoffs, dtype=float).ravel()
+        nonPoiMaxDistances = np.asarray(nonPoiMaxDistances, dtype=float).ravel()
+
+        if len(poiCutoffs) == 0 or len(nonPoiMaxDistances) == 0:
+            raise ValueError("poiCutoffs and nonPoiMaxDistances must not be empty.")
+
+        _check_parameters(stop_points, poiCutoffs.max(), nonPoiMaxDistances.max(), None, None, None)
+        _check_locations(home_location, second_place)
+
+        # the distances are computed once for the largest cutoff, the smaller cutoffs only change which of the stops are poi stops
+        stop_inverse, poi_distances, path_lengths, ratios, anchor_distances = self._stop_distances(*_stop_arrays(stop_points), stop_points.crs, home_location, poiCutoffs.max(), second_place, stats, all_stops=True, limit=nonPoiMaxDistances.max())
+
+        with _stage(stats, 'scoring'):
+            # the dwell time of each unique location
+            t = stop_points['t'].values.astype(float)
+            location_t = np.bincount(stop_inverse, weights=t, minlength=len(path_lengths))
+
+            # the poi stops for each cutoff, closer than the cutoff both in a straight line and on the network
+            is_poi_stop = (poi_distances[None, :] < poiCutoffs[:, None]) & (path_lengths[None, :] <= poiCutoffs[:, None])
+
+            # the rank_ of the stops for each maximum distance
+            rank_ = 1 - anchor_distances[None, :] / nonPoiMaxDistances[:, None]
+            rank_ = np.where(rank_ > 0, rank_, 0)
+
+            # cutoffs x maximum distances x locations
+            values = np.where(is_poi_stop[:, None, :], ratios[None, None, :], rank_[None, :, :])
+            localness = np.nansum(values * location_t, axis=2) / t.sum()
+
+            if len(stop_points)==1:
+                localness[:] = 1
+
+        return pd.DataFrame({'poiCutoff': np.repeat(poiCutoffs, len(nonPoiMaxDistances)),
+                             'nonPoiMaxDistance': np.tile(nonPoiMaxDistances, len(poiCutoffs)),
+                             'LMI': localness.ravel()})
+
+    def localness_many(self, users, poiCutoff, nonPoiMaxDistance, workers = 1, chunksize = 1, stats = None, approximate = False):
+
+        import os
+        import warnings
+        import multiprocessing
+
+        global _worker_context
+
+        # each user is a tuple of (stop_points, home_location, second_place)
+        jobs = [(stop_points, home_location, poiCutoff, nonPoiMaxDistance, second_place) for stop_points, home_location, second_place in users]
+
+        if workers is None:
+            workers = os.cpu_count()
+
+        if workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            warnings.warn("The pandana network can only be shared with forked processes, the users are computed in a single process.")
+            workers = 1
+
+        # with approximate, the approximate LMI and its lower and upper bound of each user
+        localness = self.localness_approximate if approximate else self.localness
+
+        if workers <= 1 or len(jobs) <= 1:
+            return [localness(*job, stats=stats) for job in jobs]
+
+        # computed before forking, otherwise each worker would compute it again
+        if approximate:
+            self.calibrate_detour(stats)
+        else:
+            self.compute_accessibility(stats=stats)
+            self.pandana_router(stats)
+
+        # the workers inherit the context from this process when they are forked,
+        # so only the stop points of the users are sent to them
+        _worker_context = self
+        try:
+            with multiprocessing.get_context('fork').Pool(min(workers, len(jobs))) as pool:
+                results = pool.map(_worker_localness, [(job, stats is not None, approximate) for job in jobs], chunksize=chunksize)
+        finally:
+            _worker_context = None
+
+        # the stats of each user are collected in the worker and added up here
+        if stats is not None:
+            for _, worker_stats in results:
+                stats.merge(worker_stats)
+
+        return [localness for localness, _ in results]
+
+
+# The context used by the worker processes of LMIContext.localness_many
+_worker_context = None
+
+
+def _worker_localness(task):
+
+    job, with_stats, approximate = task
+
+    stats = LMIStats() if with_stats else None
+
+    if approximate:
+        return _worker_context.localness_approximate(*job, stats=stats), stats
+
+    return _worker_context.localness(*job, stats=stats), stats
+
+
+# Memoization of the LMI results, in memory for the most recently used ones and on the disk
+class LMIResultCache:
+
+    # bump it whenever the computation of the LMI changes
+    version = 1
+
+    def __init__(self, max_entries = 1024, cache = None, snapshot = None):
+
+        import collections
+
+        # cache is an OSMCache or a directory for the disk tier, snapshot identifies the version of the osm data
+        # the results are computed with, the results of another snapshot are not used
+        self.max_entries = max_entries
+        self.cache = _get_cache(cache)
+        self.snapshot = snapshot
+        self.entries = collections.OrderedDict()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, x, y, t, crs, home_location, second_place, poiCutoff, nonPoiMaxDistance, networkBufferAreaSize = None, POITypeList = None, pois = None, stopTolerance = None, source = None):
+
+        import os
+        import hashlib
+        import json
+        import numpy as np
+        from pyproj import CRS
+
+        # the version of the pois and of the network when they do not come from Overpass
+        data = [self.snapshot]
+        if pois is not None:
+            data.append(_array_digest(pois.geometry.x.values, pois.geometry.y.values, pois['amenity'].values.astype(str), np.array(pois.crs.to_string())))
+        source = _get_source(source)
+        if source is not None and source.path is None:
+            data.append(_array_digest(*source.arrays.values(), *source.amenities.values()))
+        elif source is not None:
+            stat = os.stat(source.path)
+            data.append([os.path.abspath(source.path), stat.st_size, stat.st_mtime_ns])
+
+        content = json.dumps({
+            'version': self.version,
+            'stops': _array_digest(np.asarray(x, dtype=float), np.asarray(y, dtype=float), np.asarray(t, dtype=float)),
+            'crs': CRS.from_user_input(crs).to_string(),
+            'home': list(home_location),
+            'work': list(second_place) if second_place != -1 else -1,
+            'params': [poiCutoff, nonPoiMaxDistance, networkBufferAreaSize, sorted(POITypeList) if POITypeList is not None else None, stopTolerance],
+            'data': data,
+        }, sort_keys=True, default=str)
+
+        return 'lmi-' + hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.memory_hits += 1
+            return self.entries[key]
+
+        arrays = None
+        if self.cache is not None:
+            try:
+                arrays = self.cache.load(key)
+            except LookupError:
+                arrays = None
+
+        if arrays is None:
+            self.misses += 1
+            return None
+
+        self.disk_hits += 1
+        value = float(arrays['LMI'])
+        self._remember(key, value)
+
+        return value
+
+    def put(self, key, value):
+
+        import numpy as np
+
+        self._remember(key, value)
+
+        if self.cache is not None:
+            self.cache.save(key, {'LMI': np.array(value, dtype=float)})
+
+    def _remember(self, key, value):
+
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+
+        # only the memory tier, the disk tier is managed by its OSMCache
+        self.entries.clear()
+
+    def counters(self):
+
+        return {'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+
+def LMI(stop_points, home_location, poiCutoff, nonPoiMaxDistance, second_place = -1, networkBufferAreaSize = None, POITypeList = None, pois = None, cache = None, stats = None, stopTolerance = None, source = None, results = None, approximate = False):
+
+    _check_parameters(stop_points, poiCutoff, nonPoiMaxDistance, networkBufferAreaSize, POITypeList, pois)
+
+    _check_locations(home_location, second_place)
+
+    # the approximate LMI and its lower and upper bound, from the straight line distances and the detour factors of the network, are not memoized
+    if approximate:
+        context = LMIContext(stop_points, networkBufferAreaSize, POITypeList, pois, cache, stats, stopTolerance, source)
+
+        return context.localness_approximate(stop_points, home_location, poiCutoff, nonPoiMaxDistance, second_place, stats)
+
+    # the result of the same stop points, locations, parameters and data is reused
+    if results is not None:
+        x, y = _stop_arrays(stop_points)
+        key = results.key(x, y, stop_points['t'].values, stop_points.crs, home_location, second_place, poiCutoff, nonPoiMaxDistance,
+                          networkBufferAreaSize, POITypeList, pois, stopTolerance, source)
+        localness = results.get(key)
+        if localness is not None:
+            return localness
+
+    context = LMIContext(stop_points, networkBufferAreaSize, POITypeList, pois, cache, stats, stopTolerance, source)
+
+    localness = context.localness(stop_points, home_location, poiCutoff, nonPoiMaxDistance, second_place, stats)
+
+    if results is not None:
+        results.put(key, localness)
+
+    return localness
+
+
+def LMI_arrays(x, y, t, crs, home_location, poiCutoff, nonPoiMaxDistance, second_place = -1, networkBufferAreaSize = None, POITypeList = None, pois = None, cache = None, stats = None, stopTolerance = None, source = None):
+
+    x, y, t = _check_arrays(x, y, t, crs, poiCutoff, nonPoiMaxDistance)
+
+    _check_locations(home_location, second_place)
+
+    context = LMIContext.from_arrays(x, y, crs, networkBufferAreaSize, POITypeList, pois, cache, stats, stopTolerance, source)
+
+    return context.localness_arrays(x, y, t, crs, home_location, poiCutoff, nonPoiMaxDistance, second_place, stats)
+
+
+# The x, y and t columns of an Arrow table, a Parquet file or a DataFrame as arrays
+def _table_arrays(table, columns = ('x', 'y', 't')):
+
+    import os
+
+    if isinstance(table, (str, os.PathLike)):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("pyarrow is required to read Parquet files.")
+
+        table = pq.read_table(table, columns=list(columns))
+
+    # pyarrow tables give their columns with column(), DataFrames with []
+    if hasattr(table, 'schema') and hasattr(table, 'column'):
+        return [table.column(name).to_numpy() for name in columns]
+
+    return [table[name].to_numpy() for name in columns]
+
+
+def LMI_table(table, crs, home_location, poiCutoff, nonPoiMaxDistance, second_place = -1, columns = ('x', 'y', 't'), networkBufferAreaSize = None, POITypeList = None, pois = None, cache = None, stats = None, stopTolerance = None, source = None):
+
+    x, y, t = _table_arrays(table, columns)
+
+    return LMI_arrays(x, y, t, crs, home_location, poiCutoff, nonPoiMaxDistance, second_place, networkBufferAreaSize, POITypeList, pois, cache, stats, stopTolerance, source)
+
+
+def LMI_windows(stop_points, home_location, poiCutoff, nonPoiMaxDistance, time_column, window, step = None, second_place = -1, networkBufferAreaSize = None, POITypeList = None, pois = None, cache = None, stats = None, stopTolerance = None, source = None):
+
+    _check_parameters(stop_points, poiCutoff, nonPoiMaxDistance, networkBufferAreaSize, POITypeList, pois)
+
+    _check_locations(home_location, second_place)
+
+    context = LMIContext(stop_points, networkBufferAreaSize, POITypeList, pois, cache, stats, stopTolerance, source)
+
+    return context.localness_windows(stop_points, home_location, poiCutoff, nonPoiMaxDistance, time_column, window, step, second_place, stats)
+
+
+def LMI_sweep(stop_points, home_location, poiCutoffs, nonPoiMaxDistances, second_place = -1, networkBufferAreaSize = None, POITypeList = None, pois = None, cache = None, stats = None, stopTolerance = None, source = None):
+
+    _check_locations(home_location, second_place)
+
+    context = LMIContext(stop_points, networkBufferAreaSize, POITypeList, pois, cache, stats, stopTolerance, source)
+
+    return context.localness_sweep(stop_points, home_location, poiCutoffs, nonPoiMaxDistances, second_place, stats)
+
+
+def plan_regions(stop_points, user_column = 'user_id', networkBufferAreaSize = None, maxRegionArea = None, minRegionOverlap = 0.5):
+
+    # Groups the users whose network buffers overlap, so that one network can be built for each group
+
+    from pyproj import CRS
+
+    # Transform the GeoDataFrame to UTM CRS so the areas are in square meters
+    gdf_wgs84 = stop_points.to_crs(epsg=4326)
+    centroid = gdf_wgs84.geometry.unary_union.centroid
+    gdf = gdf_wgs84.to_crs(CRS.from_epsg(_get_utm_zone(centroid.x, centroid.y)))
+
+    buffer_size = networkBufferAreaSize if networkBufferAreaSize != None else 0
+
+    # the convex hull and the buffer of each user, the biggest ones first so they seed the regions
+    users = []
+    for user, user_gdf in gdf.groupby(user_column, sort=False):
+        convex_hull = user_gdf.unary_union.convex_hull
+        users.append((user, convex_hull, convex_hull.buffer(buffer_size)))
+    users.sort(key=lambda item: -item[2].area)
+
+    # each region is a list of [users, convex hull of their stop points, buffer of the convex hull]
+    regions = []
+    for user, convex_hull, buffer_polygon in users:
+
+        best_region = None
+        best_overlap = minRegionOverlap
+
+        for region in regions:
+            if not region[2].intersects(buffer_polygon):
+                continue
+
+            # the share of the buffer of the user that is already covered by the region
+            if buffer_polygon.area > 0:
+                overlap = region[2].intersection(buffer_polygon).area / buffer_polygon.area
+            else:
+                overlap = 1
+
+            if overlap >= best_overlap:
+                merged_hull = region[1].union(convex_hull).convex_hull
+                merged_buffer = merged_hull.buffer(buffer_size)
+
+                if maxRegionArea is None or merged_buffer.area <= maxRegionArea:
+                    best_region = region
+                    best_overlap = overlap
+                    best_merge = (merged_hull, merged_buffer)
+
+        if best_region is None:
+            regions.append([[user], convex_hull, buffer_polygon])
+        else:
+            best_region[0].append(user)
+            best_region[1], best_region[2] = best_merge
+
+    return [region[0] for region in regions]
+
+
+# Splits the users of a region in two halves along the longest side of the region
+def _split_region(stop_points, user_column):
+
+    x = stop_points.geometry.x.groupby(stop_points[user_column]).mean()
+    y = stop_points.geometry.y.groupby(stop_points[user_column]).mean()
+
+    axis = x if x.max() - x.min() >= y.max() - y.min() else y
+    users = list(axis.sort_values().index)
+
+    return [users[:len(users) // 2], users[len(users) // 2:]]
+
+
+def LMI_batch(stop_points, home_locations, poiCutoff, nonPoiMaxDistance, work_locations = None, user_column = 'user_id', networkBufferAreaSize = None, POITypeList = None, pois = None, cache = None, workers = 1, chunksize = 1, maxRegionArea = None, maxRegionNodes = None, minRegionOverlap = 0.5, stats = None, stopTolerance = None, source = None, results = None, prefetch = 0, approximate = False, rescoreThreshold = None):
+
+    import collections
+    import concurrent.futures
+    import pandas as pd
+
+    _check_parameters(stop_points, poiCutoff, nonPoiMaxDistance, networkBufferAreaSize, POITypeList, pois)
+
+    if user_column not in stop_points.columns:
+        raise ValueError("Stop Points must contain the '" + str(user_column) + "' column.")
+
+    if not isinstance(prefetch, int) or prefetch < 0:
+        raise ValueError("prefetch must be a non-negative integer.")
+
+    if not _is_numeric_or_none(rescoreThreshold):
+        raise ValueError("rescoreThreshold must be numerical or None/default.")
+
+    if rescoreThreshold is not None and not approximate:
+        raise ValueError("rescoreThreshold can only be used with approximate.")
+
+    if work_locations is None:
+        work_locations = {}
+
+    # Check that every user has a home location and that home and work locations are tuples of two numbers
+    users = list(pd.unique(stop_points[user_column]))
+    for user in users:
+        if user not in home_locations:
+            raise ValueError("Home Location is missing for user " + str(user) + ".")
+        _check_locations(home_locations[user], work_locations[user] if user in work_locations else -1)
+
+    # the extract is read once and shared by all the regions
+    cache = _get_cache(cache)
+    source = _get_source(source)
+
+    users_localness = {}
+    users_bounds = {}
+    users_region = {}
+    users_key = {}
+    networks_built = 0
+    networks_used = 0
+
+    # the users whose result is already known are not computed again, and are in no region
+    if results is not None:
+        for user, user_stop_points in stop_points.groupby(user_column, sort=False):
+            x, y = _stop_arrays(user_stop_points)
+            users_key[user] = results.key(x, y, user_stop_points['t'].values, stop_points.crs, home_locations[user],
+                                          work_locations[user] if user in work_locations else -1, poiCutoff, nonPoiMaxDistance,
+                                          networkBufferAreaSize, POITypeList, pois, stopTolerance, source)
+            localness = results.get(users_key[user])
+            if localness is not None:
+                users_localness[user] = localness
+                users_bounds[user] = (localness, localness, True)
+                users_region[user] = -1
+
+    remaining_users = [user for user in users if user not in users_localness]
+    remaining_stop_points = stop_points[stop_points[user_column].isin(remaining_users)]
+
+    # The network and the pois are downloaded and built once for the whole cohort,
+    # or once for each group of users whose buffers overlap when the regions are limited
+    if not remaining_users:
+        regions = []
+    elif maxRegionArea is None and maxRegionNodes is None:
+        regions = [remaining_users]
+    else:
+        regions = plan_regions(remaining_stop_points, user_column, networkBufferAreaSize, maxRegionArea, minRegionOverlap)
+
+    def fetch(region_users):
+
+        # each thread has its own stats, they are merged once the region is scored
+        region_stop_points = stop_points[stop_points[user_column].isin(region_users)]
+        x, y = _stop_arrays(region_stop_points)
+        fetch_stats = LMIStats() if stats is not None else None
+
+        area = _fetch_area(x, y, stop_points.crs, networkBufferAreaSize, POITypeList, pois, cache, fetch_stats, source)
+
+        return area, fetch_stats
+
+    # The networks and the pois of the next regions are downloaded in threads while the current region is scored,
+    # at most prefetch regions are waiting so only that many networks are held in memory
+    executor = concurrent.futures.ThreadPoolExecutor(prefetch) if prefetch > 0 else None
+    pending = collections.deque()
+
+    def submit():
+
+        while regions and len(pending) < max(prefetch, 1):
+            region_users = regions.pop(0)
+            pending.append((region_users, executor.submit(fetch, region_users) if executor is not None else None))
+
+    try:
+        while regions or pending:
+            submit()
+            region_users, future = pending.popleft()
+            submit()
+
+            area, fetch_stats = future.result() if future is not None else fetch(region_users)
+            if stats is not None:
+                stats.merge(fetch_stats)
+
+            region_stop_points = stop_points[stop_points[user_column].isin(region_users)]
+
+            context = LMIContext._from_area(area, cache, stats, stopTolerance)
+            del area
+            networks_built += 1
+
+            # The number of nodes is only known once the network is downloaded, the regions that are too big are split
+            if maxRegionNodes is not None and len(context.node_index) > maxRegionNodes and len(region_users) > 1:
+                regions[:0] = _split_region(region_stop_points, user_column)
+                continue
+
+            jobs = []
+            region_users = []
+            for user, user_stop_points in region_stop_points.groupby(user_column, sort=False):
+                second_place = work_locations[user] if user in work_locations else -1
+                jobs.append((user_stop_points, home_locations[user], second_place))
+                region_users.append(user)
+
+            if approximate:
+                values = context.localness_many(jobs, poiCutoff, nonPoiMaxDistance, workers, chunksize, stats, approximate=True)
+                exact = [False] * len(jobs)
+
+                # the users whose bounds are on both sides of the threshold could fall on the other side of it,
+                # only they are scored again with the network distances
+                if rescoreThreshold is not None:
+                    rescore = [i for i, (_, lower, upper) in enumerate(values) if lower <= rescoreThreshold <= upper]
+                    for i, localness in zip(rescore, context.localness_many([jobs[i] for i in rescore], poiCutoff, nonPoiMaxDistance, workers, chunksize, stats)):
+                        values[i] = (localness, localness, localness)
+                        exact[i] = True
+            else:
+                values = [(localness, localness, localness) for localness in context.localness_many(jobs, poiCutoff, nonPoiMaxDistance, workers, chunksize, stats)]
+                exact = [True] * len(jobs)
+
+            for user, (localness, lower, upper), is_exact in zip(region_users, values, exact):
+                users_localness[user] = localness
+                users_bounds[user] = (lower, upper, is_exact)
+                users_region[user] = networks_used
+
+                if results is not None and is_exact:
+                    results.put(users_key[user], localness)
+
+            networks_used += 1
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    result = pd.DataFrame({user_column: users, 'LMI': [users_localness[user] for user in users], 'region': [users_region[user] for user in users]})
+
+    # the bounds of the approximate LMI, equal to the LMI for the users scored exactly
+    if approximate:
+        result['LMI_lower'] = [users_bounds[user][0] for user in users]
+        result['LMI_upper'] = [users_bounds[user][1] for user in users]
+        result['exact'] = [users_bounds[user][2] for user in users]
+
+    # how many networks were built and how many users shared each of them
+    result.attrs['networks_built'] = networks_built
+    result.attrs['networks_used'] = networks_used
+    result.attrs['users_per_network'] = len(remaining_users) / networks_used if networks_used else 0
+
+    return result
+
+
+# Persistent store of the localness of each stop point of the users, so that new stop points can be added
+# to the LMI of a user without computing the whole history again
+class LMIStore:
+
+    def __init__(self, path):
+
+        import sqlite3
+
+        self.path = path
+        self.connection = sqlite3.connect(path)
+
+        # the parameters the stored values were computed with, and the stop points in WGS 84 with their
+        # dwell time and their localness (the ratio of the poi stops and the rank_ of the non-poi stops)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS users (user TEXT PRIMARY KEY, params TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS stops (user TEXT, x REAL, y REAL, t REAL, value REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS stops_user ON stops (user)")
+        # the area of the context the stored values of each user were computed in, with its UTM crs
+        self.connection.execute("CREATE TABLE IF NOT EXISTS areas (user TEXT PRIMARY KEY, crs TEXT, polygon TEXT)")
+        self.connection.commit()
+
+    def close(self):
+
+        self.connection.close()
+
+    def params(self, stop_points, home_location, poiCutoff, nonPoiMaxDistance, second_place = -1, networkBufferAreaSize = None, POITypeList = None):
+
+        import json
+
+        # the stored values of a user are only valid for the same home and work locations and parameters
+        return json.dumps([stop_points.crs.to_string(), list(home_location), list(second_place) if second_place != -1 else -1,
+                           poiCutoff, nonPoiMaxDistance, networkBufferAreaSize, sorted(POITypeList) if POITypeList is not None else None])
+
+    def stop_points(self, user):
+
+        import geopandas as gpd
+
+        rows = self.connection.execute("SELECT x, y, t FROM stops WHERE user = ?", (str(user),)).fetchall()
+
+        return gpd.GeoDataFrame({'t': [row[2] for row in rows]},
+                                geometry=gpd.points_from_xy([row[0] for row in rows], [row[1] for row in rows]), crs='EPSG:4326')
+
+    def area(self, user):
+
+        from shapely import wkt
+
+        row = self.connection.execute("SELECT crs, polygon FROM areas WHERE user = ?", (str(user),)).fetchone()
+
+        return (row[0], wkt.loads(row[1])) if row is not None else None
+
+    def update(self, user, stop_points, home_location, poiCutoff, nonPoiMaxDistance, second_place = -1, networkBufferAreaSize = None, POITypeList = None, pois = None, cache = None, context = None, stats = None, stopTolerance = None, source = None):
+
+        import pandas as pd
+        import geopandas as gpd
+        import shapely
+        from shapely import wkt
+
+        _check_parameters(stop_points, poiCutoff, nonPoiMaxDistance, networkBufferAreaSize, POITypeList, pois)
+        _check_locations(home_location, second_place)
+
+        params = self.params(stop_points, home_location, poiCutoff, nonPoiMaxDistance, second_place, networkBufferAreaSize, POITypeList)
+
+        row = self.connection.execute("SELECT params FROM users WHERE user = ?", (str(user),)).fetchone()
+
+        stored = self.stop_points(user).to_crs(stop_points.crs)
+        all_stop_points = gpd.GeoDataFrame(pd.concat([stored, stop_points[['t', 'geometry']]], ignore_index=True), crs=stop_points.crs)
+
+        # when the locations or the parameters changed, the stored stop points are computed again with the new ones
+        replace = row is not None and row[0] != params
+
+        if context is None:
+            # the context covers all the stop points of the user, like the one of LMI computed over all of them
+            context = LMIContext(all_stop_points, networkBufferAreaSize, POITypeList, pois, cache, stats, stopTolerance, source)
+
+            # when the new stop points extend the area, the stored ones are computed again in the new one
+            area = self.area(user)
+            if len(stored) > 0 and (area is None or area[0] != context.crs.to_string() or not shapely.equals_exact(area[1], context.polygon, 1e-7)):
+                replace = True
+
+        if replace:
+            stop_points = all_stop_points
+
+        # only the new stop points are computed, the dwell time normalization is done when the LMI is read
+        values = context.stop_contributions(stop_points, home_location, poiCutoff, nonPoiMaxDistance, second_place, stats)
+
+        stop_points_wgs84 = stop_points.to_crs(epsg=4326)
+
+        # the store is only changed once all the values are computed, in one transaction, so a failure leaves it as it was
+        with self.connection:
+            if replace:
+                self.connection.execute("DELETE FROM stops WHERE user = ?", (str(user),))
+            self.connection.execute("INSERT OR REPLACE INTO users (user, params) VALUES (?, ?)", (str(user), params))
+            self.connection.execute("INSERT OR REPLACE INTO areas (user, crs, polygon) VALUES (?, ?, ?)", (str(user), context.crs.to_string(), wkt.dumps(context.polygon)))
+            self.connection.executemany("INSERT INTO stops (user, x, y, t, value) VALUES (?, ?, ?, ?, ?)",
+                                        zip([str(user)] * len(values), stop_points_wgs84.geometry.x.tolist(), stop_points_wgs84.geometry.y.tolist(),
+                                            stop_points['t'].astype(float).tolist(), values.tolist()))
+
+        return self.localness(user)
+
+    def localness(self, user):
+
+        import numpy as np
+
+        # the values that could not be computed are stored as NULL and skipped by TOTAL, like nansum does
+        count, weighted, total = self.connection.execute("SELECT COUNT(*), TOTAL(value * t), TOTAL(t) FROM stops WHERE user = ?", (str(user),)).fetchone()
+
+        if count == 0:
+            return np.nan
+
+        if count == 1:
+            return 1
+
+        return weighted / total
+
+    def remove(self, user):
+
+        self.connection.execute("DELETE FROM stops WHERE user = ?", (str(user),))
+        self.connection.execute("DELETE FROM users WHERE user = ?", (str(user),))
+        self.connection.execute("DELETE FROM areas WHERE user = ?", (str(user),))
+        self.connection.commit()
@@ -0,0 +1,309 @@
+# Long running LMI server: the regions are prepared once when the server starts, and the LMI requests are answered
+# over HTTP from the networks and the POI indexes kept in memory, without importing, downloading or building anything.
+#
+#     python LMI_server.py regions.json --port 8765
+#
+# The regions file maps the name of each region to a saved LMIContext, or to the box it covers:
+#
+#     {"regions": {
+#         "london": {"context": "london.npz"},
+#         "toronto": {"bbox": [-79.64, 43.58, -79.11, 43.86], "networkBufferAreaSize": 1000, "cache": "osm_cache", "context": "toronto.npz"}
+#     }}
+#
+# A region with a bbox (in WGS 84, or in its "crs") is downloaded, or clipped from its "source" extract, and saved to
+# its "context" path when one is given, so the next start loads it. The other keys are the parameters of LMIContext.
+
+from LMI import LMIContext, LMIStats, OSMExtract, _get_transformer
+
+
+def load_regions(config, stats = None):
+
+    import os
+
+    # the regions clipped from the same extract share it, so it is only read once
+    extracts = {}
+
+    regions = {}
+    for name, region in config['regions'].items():
+        path = region.get('context')
+
+        if path is not None and os.path.exists(path):
+            context = LMIContext.load(path, stats)
+        elif 'bbox' in region:
+            # the corners of the box, so the buffer area covers all of it
+            min_x, min_y, max_x, max_y = region['bbox']
+            source = region.get('source')
+            if source is not None:
+                if source not in extracts:
+                    extracts[source] = OSMExtract(source)
+                source = extracts[source]
+            context = LMIContext.from_arrays([min_x, max_x, max_x, min_x], [min_y, min_y, max_y, max_y], region.get('crs', 'EPSG:4326'),
+                                             region.get('networkBufferAreaSize'), region.get('POITypeList'), None, region.get('cache'), stats,
+                                             region.get('stopTolerance'), source)
+            if path is not None:
+                context.save(path)
+        else:
+            raise ValueError("Region '" + str(name) + "' needs a bbox or an existing context.")
+
+        # everything computed lazily is computed now, so the requests only read the context
+        context.compute_accessibility(stats=stats)
+        context.calibrate_detour(stats)
+
+        regions[name] = context
+
+    return regions
+
+
+# A request that could not get its turn: the queue is full, or it waited longer than queue_timeout
+class ServerBusy(RuntimeError):
+    pass
+
+
+class LMIServer:
+
+    def __init__(self, regions, max_concurrency = 4, max_queue = 64, queue_timeout = 10):
+
+        import threading
+        import collections
+
+        # the requests of a region are answered one at a time as the contexts are not thread safe, and max_concurrency
+        # requests are computed at once over all the regions. A request waits for its region and then for a slot,
+        # counted as waiting the whole time: up to max_queue requests wait for their turn, the others are rejected,
+        # as are the ones waiting longer than queue_timeout seconds
+        self.regions = regions
+        self.region_locks = {name: threading.Lock() for name in regions}
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.in_flight = 0
+        self.counters = collections.Counter()
+        self.latencies = collections.deque(maxlen=1000)
+        self.stats = LMIStats()
+
+    def region_of(self, x, y, crs):
+
+        import numpy as np
+        import shapely
+
+        # the first region whose buffer area contains all the stop points
+        lon, lat = _get_transformer(crs, 'EPSG:4326').transform(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        for name, context in self.regions.items():
+            if shapely.contains_xy(context.polygon, lon, lat).all():
+                return name
+
+        raise LookupError("No region covers the stop points.")
+
+    def wait(self, lock, deadline):
+
+        import time
+
+        with self.lock:
+            if self.waiting >= self.max_queue:
+                self.counters['rejected'] += 1
+                raise ServerBusy('Too many requests are waiting.')
+            self.waiting += 1
+
+        acquired = lock.acquire(timeout=max(deadline - time.monotonic(), 0))
+
+        with self.lock:
+            self.waiting -= 1
+            if not acquired:
+                self.counters['rejected'] += 1
+                raise ServerBusy('Timed out waiting for its turn.')
+
+    def compute(self, request, stats = None, deadline = None):
+
+        import time
+
+        # one request: the stop points as x, y and t arrays in crs, the home and work locations and the parameters
+        stops = request['stops']
+        crs = request.get('crs', 'EPSG:4326')
+        second_place = request.get('work')
+        second_place = tuple(second_place) if second_place is not None else -1
+        args = (stops['x'], stops['y'], stops['t'], crs, tuple(request['home']), request['poiCutoff'], request['nonPoiMaxDistance'], second_place)
+
+        name = request.get('region')
+        if name is None:
+            name = self.region_of(stops['x'], stops['y'], crs)
+        if name not in self.regions:
+            raise LookupError("Unknown region '" + str(name) + "'.")
+
+        if deadline is None:
+            deadline = time.monotonic() + self.queue_timeout
+
+        # the region first and then a slot, so no slot is held while waiting for a region
+        context = self.regions[name]
+        self.wait(self.region_locks[name], deadline)
+        try:
+            self.wait(self.slots, deadline)
+            with self.lock:
+                self.in_flight += 1
+            try:
+                if request.get('approximate', False):
+                    lmi, lower, upper = context.localness_approximate_arrays(*args, stats=stats)
+                    return {'region': name, 'LMI': lmi, 'LMI_lower': lower, 'LMI_upper': upper}
+
+                return {'region': name, 'LMI': float(context.localness_arrays(*args, stats=stats))}
+            finally:
+                self.slots.release()
+                with self.lock:
+                    self.in_flight -= 1
+        finally:
+            self.region_locks[name].release()
+
+    def handle(self, body):
+
+        import time
+
+        # a single request, or a batch of them in "requests" answered in the same order, all of them within queue_timeout
+        batch = body.get('requests') if isinstance(body, dict) else None
+        requests = batch if batch is not None else [body]
+
+        start = time.perf_counter()
+        deadline = time.monotonic() + self.queue_timeout
+        stats = LMIStats()
+        responses = []
+        busy = False
+        for request in requests:
+            # any error of a request, an unknown crs raises a RuntimeError of pyproj, is answered for that request only
+            try:
+                responses.append(self.compute(request, stats, deadline))
+            except ServerBusy as error:
+                busy = True
+                responses.append({'error': str(error)})
+            except Exception as error:
+                responses.append({'error': type(error).__name__ + ': ' + str(error)})
+
+        with self.lock:
+            self.counters['requests'] += 1
+            self.counters['users'] += len(requests)
+            self.counters['errors'] += sum('error' in response for response in responses)
+            self.latencies.append(time.perf_counter() - start)
+            self.stats.merge(stats)
+
+        if batch is not None:
+            return 200, {'responses': responses}
+        if busy:
+            return 503, responses[0]
+        return (400 if 'error' in responses[0] else 200), responses[0]
+
+    def health(self):
+
+        return {'status': 'ok', 'regions': sorted(self.regions)}
+
+    def metrics(self):
+
+        import numpy as np
+
+        with self.lock:
+            latencies = np.array(self.latencies)
+            metrics = {
+                'requests': self.counters['requests'],
+                'users': self.counters['users'],
+                'errors': self.counters['errors'],
+                'rejected': self.counters['rejected'],
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'max_concurrency': self.max_concurrency,
+                'max_queue': self.max_queue,
+                'stats': self.stats.as_dict(),
+            }
+
+        # latency of the last 1000 requests, in seconds
+        if len(latencies) > 0:
+            metrics['latency'] = {name: float(np.quantile(latencies, q)) for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))}
+
+        return metrics
+
+    def serve(self, host = '127.0.0.1', port = 8765):
+
+        from http.server import ThreadingHTTPServer
+
+        server = ThreadingHTTPServer((host, port), _handler(self))
+        print('Serving', ', '.join(sorted(self.regions)), 'on http://' + host + ':' + str(server.server_address[1]), flush=True)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+
+def _handler(lmi_server):
+
+    import json
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def reply(self, status, content):
+
+            data = json.dumps(content).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+
+            if self.path == '/health':
+                self.reply(200, lmi_server.health())
+            elif self.path == '/metrics':
+                self.reply(200, lmi_server.metrics())
+            else:
+                self.reply(404, {'error': 'Not found.'})
+
+        def do_POST(self):
+
+            if self.path != '/lmi':
+                self.reply(404, {'error': 'Not found.'})
+                return
+
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except ValueError:
+                self.reply(400, {'error': 'The body is not valid JSON.'})
+                return
+
+            try:
+                status, content = lmi_server.handle(body)
+            except Exception as error:
+                self.reply(500, {'error': type(error).__name__ + ': ' + str(error)})
+                return
+
+            self.reply(status, content)
+
+        def log_message(self, format, *args):
+
+            # the requests are counted in the metrics instead of being logged
+            pass
+
+    return Handler
+
+
+def main():
+
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description='Answers LMI requests from regions kept in memory.')
+    parser.add_argument('config', help='JSON file of the regions')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-concurrency', type=int, default=4, help='requests computed at once')
+    parser.add_argument('--max-queue', type=int, default=64, help='requests waiting for a slot before the next ones are rejected')
+    parser.add_argument('--queue-timeout', type=float, default=10, help='seconds a request waits for a slot')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    lmi_server = LMIServer(load_regions(config), args.max_concurrency, args.max_queue, args.queue_timeout)
+    lmi_server.serve(args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()